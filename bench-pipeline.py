@@ -0,0 +1,204 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+Latency benchmark of the task cycle of the QLA data server, comparing
+serial requests with HTTP/1.1 pipelining.
+
+A task cycle is what a worker does to finish its current task and get
+the next one: an /end_task request for the previous task and a
+/get_task request for the next one.
+
+In serial mode, the worker sends /end_task, waits for its response,
+then sends /get_task and waits for its response: two round trips per
+cycle.
+
+In pipelined mode, the worker sends both requests at once on the same
+connection and then reads both responses: one round trip per cycle.
+
+Every cycle moves an input file of the server to the processed folder,
+and each mode takes one more task before its first cycle, so the input
+folder of the server must hold at least 2 x CYCLES + 2 files (the server
+can also be started with dummy files). Example:
+
+  $ test-dataserver.py -r ~/www &
+  $ bench-pipeline.py --host localhost --port 8080 --cycles 500
+'''
+
+VERSION = '0.1'
+
+from time import time
+
+import argparse
+import json
+import socket
+import sys
+
+
+class HTTPConnection(object):
+    '''
+    Minimal persistent HTTP/1.1 client connection, that can send several
+    requests before reading their responses.
+    '''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+
+    def send(self, *paths):
+        '''
+        Send GET requests for the paths, all at once
+        '''
+        self.sock.sendall(''.join('GET {} HTTP/1.1\r\nHost: {}\r\n\r\n'.format(path, self.host)
+                                  for path in paths))
+
+    def read_response(self):
+        '''
+        Read the next response
+        :return: Status code and body
+        '''
+        status_line = self.rfile.readline()
+        if not status_line:
+            raise IOError('Connection closed by the server')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = self.rfile.readline().strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return status, ''.join(chunks)
+        return status, self.rfile.read(int(headers.get('content-length', 0)))
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+def get_task_id(status, body):
+    '''
+    Get the task id of a /get_task response
+    '''
+    if status != 200:
+        raise IOError('No task received (status {}), are there enough input files?'.format(status))
+    return json.loads(body)['task_id']
+
+
+def run_serial(conn, cycles):
+    '''
+    Run task cycles waiting for every response before the next request
+    :return: List of cycle latencies, in seconds
+    '''
+    conn.send('/get_task?wait=0')
+    task_id = get_task_id(*conn.read_response())
+    latencies = []
+    for _ in range(cycles):
+        start = time()
+        conn.send('/end_task?task_id=' + task_id)
+        conn.read_response()
+        conn.send('/get_task?wait=0')
+        task_id = get_task_id(*conn.read_response())
+        latencies.append(time() - start)
+    conn.send('/end_task?task_id=' + task_id)
+    conn.read_response()
+    return latencies
+
+
+def run_pipelined(conn, cycles):
+    '''
+    Run task cycles sending the /end_task and /get_task requests at once
+    :return: List of cycle latencies, in seconds
+    '''
+    conn.send('/get_task?wait=0')
+    task_id = get_task_id(*conn.read_response())
+    latencies = []
+    for _ in range(cycles):
+        start = time()
+        conn.send('/end_task?task_id=' + task_id, '/get_task?wait=0')
+        conn.read_response()
+        task_id = get_task_id(*conn.read_response())
+        latencies.append(time() - start)
+    conn.send('/end_task?task_id=' + task_id)
+    conn.read_response()
+    return latencies
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(name, latencies):
+    '''
+    Print latency statistics, in milliseconds
+    '''
+    latencies = sorted(latencies)
+    mean = sum(latencies) / len(latencies)
+    print('{:10s} cycles={:6d} mean={:8.3f} p50={:8.3f} p95={:8.3f} p99={:8.3f} max={:8.3f} ms'.format(
+        name, len(latencies), mean * 1e3, percentile(latencies, 0.5) * 1e3,
+        percentile(latencies, 0.95) * 1e3, percentile(latencies, 0.99) * 1e3,
+        latencies[-1] * 1e3))
+    return mean
+
+
+def getopts():
+    '''
+    Get the command line options.
+    '''
+    description = ('description:%s' % '\n  '.join(__doc__.split('\n')))
+    rawd = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(formatter_class=rawd, description=description)
+
+    parser.add_argument('-H', '--host',
+                        action='store',
+                        type=str,
+                        default='localhost',
+                        help='hostname of the server, default=%(default)s')
+
+    parser.add_argument('-p', '--port',
+                        action='store',
+                        type=int,
+                        default=8080,
+                        help='port of the server, default=%(default)s')
+
+    parser.add_argument('-n', '--cycles',
+                        action='store',
+                        type=int,
+                        default=100,
+                        help='task cycles run in each mode, default=%(default)s')
+
+    parser.add_argument('-V', '--version',
+                        action='version',
+                        version='%(prog)s - v' + VERSION)
+
+    return parser.parse_args()
+
+
+def main():
+    ''' main entry '''
+    opts = getopts()
+    results = {}
+    for name, run in (('serial', run_serial), ('pipelined', run_pipelined)):
+        conn = HTTPConnection(opts.host, opts.port)
+        try:
+            results[name] = report(name, run(conn, opts.cycles))
+        except (IOError, socket.error) as e:
+            print('ERROR: %s' % (e))
+            sys.exit(1)
+        finally:
+            conn.close()
+    print('pipelining speedup: {:.2f}x'.format(results['serial'] / results['pipelined']))
+
+
+if __name__ == '__main__':
+    main()
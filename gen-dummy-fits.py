@@ -0,0 +1,312 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+'''
+Generator of synthetic VIS LE1 frames, to load test the QLA data server
+with production data volumes.
+
+Every frame is a FITS file with an empty primary HDU and one image
+extension per detector quadrant, filled with a bias level, sky
+background, read and photon noise, stars and cosmic rays.  The files are
+named like the ones the server expects in its input folder:
+
+  EUC_LE1_VIS-W-<obs id>-<dither>_<date>.0Z.fits
+
+The frames are generated in parallel by a pool of processes, and are
+the same for the same seed whatever the number of processes.  Each file
+is written under a temporary name and renamed when complete, so a
+running server never picks up a partial file.
+
+Headers can be completed with a template: a text file with one FITS
+card per line, as written by astropy's Header.totextfile, whose string
+values may contain the fields {obs_id}, {dither}, {frame} and {date}.
+Any other text between braces is copied as it is.
+
+Example, 1000 frames of 4 quadrants of 2066x2048 16-bit pixels:
+
+  $ gen-dummy-fits.py -o ~/www/input -n 1000 --extensions 4 --seed 42
+'''
+
+VERSION = '0.1'
+
+from time import time
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+
+from astropy.io import fits
+import numpy as np
+
+
+DTYPES = ['uint16', 'int16', 'int32', 'float32', 'float64']
+TEMPLATE_FIELDS = re.compile(r'\{(obs_id|dither|frame|date)\}')
+
+
+def frame_name(obs_id, dither, date):
+    return 'EUC_LE1_VIS-W-{}-{}_{}.0Z.fits'.format(obs_id, dither, date.strftime('%Y%m%dT%H%M%S'))
+
+
+def make_image(rng, shape, dtype, opts):
+    '''
+    Make the pixels of a quadrant
+    :param rng: numpy RandomState of the frame
+    :param shape: (rows, columns) of the image
+    :param dtype: numpy type of the pixels
+    :param opts: Command line options
+    :return: Image array
+    '''
+    # Sky and photon noise, then bias and read noise
+    image = rng.poisson(opts.sky, shape).astype(np.float32)
+    image += rng.normal(opts.bias, opts.read_noise, shape).astype(np.float32)
+
+    # Stars as 3x3 pixel blobs with power-law fluxes, and cosmic rays as
+    # single saturated pixels
+    n_stars = rng.poisson(opts.stars)
+    if n_stars:
+        rows = rng.randint(1, shape[0] - 1, n_stars)
+        cols = rng.randint(1, shape[1] - 1, n_stars)
+        fluxes = (rng.pareto(1.5, n_stars) + 1) * 10 * opts.sky
+        kernel = np.array([[1, 2, 1], [2, 4, 2], [1, 2, 1]], dtype=np.float32) / 16
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                np.add.at(image, (rows + dr, cols + dc), fluxes * kernel[dr + 1, dc + 1])
+    n_cosmics = rng.poisson(opts.cosmics)
+    if n_cosmics:
+        image[rng.randint(0, shape[0], n_cosmics), rng.randint(0, shape[1], n_cosmics)] = 65000
+
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.clip(image, info.min, info.max, out=image)
+    return image.astype(dtype)
+
+
+def fill_template(template, fields):
+    '''
+    Copy a header template, replacing the fields in its string values
+    '''
+    header = template.copy()
+    # Only the known fields are replaced: other braces are kept as they are
+    def field(match):
+        return str(fields[match.group(1)])
+    # By index: COMMENT and HISTORY cards are appended when set by
+    # keyword, and repeated keywords would only update their first card
+    for i, card in enumerate(list(header.cards)):
+        if isinstance(card.value, basestring):
+            header[i] = TEMPLATE_FIELDS.sub(field, card.value)
+    return header
+
+
+def make_frame(args):
+    '''
+    Generate and write a frame
+    :param args: (index of the frame, options, header template)
+    :return: Path and size of the file
+    '''
+    index, opts, template = args
+    obs_id = opts.obs_start + index // opts.dithers
+    dither = index % opts.dithers + 1
+    date = opts.start + timedelta(seconds=index * opts.exptime)
+    path = os.path.join(opts.output, frame_name(obs_id, dither, date))
+    rng = np.random.RandomState([opts.seed, index])
+
+    fields = {'obs_id': obs_id, 'dither': dither, 'frame': index, 'date': date.isoformat()}
+    primary = fits.PrimaryHDU(header=fill_template(template, fields))
+    primary.header['TELESCOP'] = 'EUCLID'
+    primary.header['INSTRUME'] = 'VIS'
+    primary.header['OBS_ID'] = obs_id
+    primary.header['DITHOBS'] = dither
+    primary.header['DATE-OBS'] = date.isoformat()
+    primary.header['EXPTIME'] = opts.exptime
+    primary.header['SEED'] = (opts.seed, 'seed of the synthetic data')
+    hdus = [primary]
+    for quadrant in range(opts.extensions):
+        hdu = fits.ImageHDU(make_image(rng, opts.shape, opts.dtype, opts),
+                            name='CCD_{}'.format(quadrant + 1))
+        hdu.header['BIASLVL'] = opts.bias
+        hdu.header['RDNOISE'] = opts.read_noise
+        hdus.append(hdu)
+
+    tmp_path = path + '.part'
+    fits.HDUList(hdus).writeto(tmp_path, overwrite=True)
+    os.rename(tmp_path, path)
+    return path, os.path.getsize(path)
+
+
+def parse_shape(value):
+    try:
+        rows, cols = [int(n) for n in value.lower().split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected ROWSxCOLUMNS: ' + value)
+    if rows < 3 or cols < 3:
+        raise argparse.ArgumentTypeError('images must be at least 3x3: ' + value)
+    return rows, cols
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected YYYY-mm-ddTHH:MM:SS: ' + value)
+
+
+def getopts():
+    '''
+    Get the command line options.
+    '''
+    description = ('description:%s' % '\n  '.join(__doc__.split('\n')))
+    rawd = argparse.RawDescriptionHelpFormatter
+    parser = argparse.ArgumentParser(formatter_class=rawd, description=description)
+
+    parser.add_argument('-o', '--output',
+                        action='store',
+                        type=str,
+                        default='input',
+                        help='folder where the frames are written, default=%(default)s')
+
+    parser.add_argument('-n', '--frames',
+                        action='store',
+                        type=int,
+                        default=100,
+                        help='number of frames, default=%(default)s')
+
+    parser.add_argument('--dithers',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='frames per observation, default=%(default)s')
+
+    parser.add_argument('--obs-start',
+                        action='store',
+                        type=int,
+                        default=12000,
+                        help='id of the first observation, default=%(default)s')
+
+    parser.add_argument('--start',
+                        action='store',
+                        type=parse_date,
+                        default='2020-01-01T00:00:00',
+                        help='date of the first frame, default=%(default)s')
+
+    parser.add_argument('--exptime',
+                        action='store',
+                        type=float,
+                        default=565.0,
+                        help='seconds between frames, default=%(default)s')
+
+    parser.add_argument('--extensions',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='image extensions (quadrants) per frame, default=%(default)s')
+
+    parser.add_argument('--shape',
+                        action='store',
+                        type=parse_shape,
+                        default='2066x2048',
+                        help='ROWSxCOLUMNS of every image, default=%(default)s')
+
+    parser.add_argument('--dtype',
+                        action='store',
+                        type=str,
+                        default='uint16',
+                        choices=DTYPES,
+                        help='type of the pixels, default=%(default)s')
+
+    parser.add_argument('--header-template',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='text file with FITS cards added to every primary header')
+
+    parser.add_argument('--bias',
+                        action='store',
+                        type=float,
+                        default=1000.0,
+                        help='bias level in ADU, default=%(default)s')
+
+    parser.add_argument('--read-noise',
+                        action='store',
+                        type=float,
+                        default=4.5,
+                        help='read noise in ADU, default=%(default)s')
+
+    parser.add_argument('--sky',
+                        action='store',
+                        type=float,
+                        default=120.0,
+                        help='sky background in ADU, default=%(default)s')
+
+    parser.add_argument('--stars',
+                        action='store',
+                        type=float,
+                        default=2000.0,
+                        help='mean number of stars per image, default=%(default)s')
+
+    parser.add_argument('--cosmics',
+                        action='store',
+                        type=float,
+                        default=500.0,
+                        help='mean number of cosmic ray hits per image, default=%(default)s')
+
+    parser.add_argument('-s', '--seed',
+                        action='store',
+                        type=int,
+                        default=0,
+                        help='seed of the random data, default=%(default)s')
+
+    parser.add_argument('-j', '--jobs',
+                        action='store',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='processes generating frames, default=%(default)s')
+
+    parser.add_argument('-V', '--version',
+                        action='version',
+                        version='%(prog)s - v' + VERSION)
+
+    opts = parser.parse_args()
+    if opts.frames < 1 or opts.dithers < 1 or opts.jobs < 1 or opts.extensions < 0:
+        parser.error('frames, dithers and jobs must be positive, extensions not negative')
+    if opts.seed < 0:
+        parser.error('the seed cannot be negative')
+    opts.dtype = np.dtype(opts.dtype)
+    return opts
+
+
+def main():
+    ''' main entry '''
+    opts = getopts()
+    template = fits.Header()
+    if opts.header_template:
+        try:
+            template = fits.Header.fromtextfile(opts.header_template)
+        except (IOError, ValueError) as e:
+            print('ERROR: cannot read the header template: %s' % (e))
+            sys.exit(1)
+    if not os.path.isdir(opts.output):
+        os.makedirs(opts.output)
+
+    pool = multiprocessing.Pool(opts.jobs)
+    start = time()
+    total_size = 0
+    try:
+        frames = pool.imap_unordered(make_frame, [(index, opts, template) for index in range(opts.frames)])
+        for done, (path, size) in enumerate(frames, 1):
+            total_size += size
+            if done % max(opts.frames // 20, 1) == 0 or done == opts.frames:
+                elapsed = time() - start
+                print('{:6d}/{} frames {:10.1f} MiB {:8.1f} MiB/s  {}'.format(
+                    done, opts.frames, total_size / 1048576.0,
+                    total_size / 1048576.0 / max(elapsed, 1e-6), os.path.basename(path)))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        sys.exit(1)
+    finally:
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -52,6 +52,75 @@ index.html or index.htm directory, type three trailing backslashes in
 the URL like this: http://foo/bar/spam///. This will not work if the
 --no-dirlist option is specified.
 
+By default every connection is served by its own thread. With
+"--engine pool" a fixed number of threads ("--pool-size") serve the
+connections waiting in a bounded queue ("--queue-depth"); when it is
+full, new connections get a "503 Service Unavailable" answer. With
+"--engine async" a single event-driven thread serves all of them, which
+scales to thousands of idle keep-alive connections. With all engines,
+connections are kept open (HTTP/1.1) for "--idle-timeout" seconds. Serving
+statistics are available at http://0.0.0.0:8080/status.
+
+Files served are kept in an in-memory LRU cache of "--cache-size" MiB
+(files up to "--cache-max-file" MiB), and read again when they change.
+Clients that accept it get "file.gz" or "file.br" instead of "file" when
+it exists, and text and JSON files compressed on the fly otherwise.
+
+The primary headers of the input files are indexed when they arrive.
+http://0.0.0.0:8080/meta?file=... returns the headers of a file, and
+http://0.0.0.0:8080/search?OBS_ID=12000&DITHOBS=3 the files matching
+the given keyword values.  A single HDU or a region of an image is
+available with http://0.0.0.0:8080/cutout?file=...&hdu=CCD_1&rows=0:100&cols=0:100
+(and "&format=raw" for the pixels only), and quick-look statistics and
+histograms of its images with http://0.0.0.0:8080/stats?file=...
+
+Browsers can show a FITS frame with http://0.0.0.0:8080/preview?file=...
+(and "&hdu=CCD_2&size=256&format=jpeg"), a PNG or JPEG image reduced to
+"--preview-size" pixels and stretched with zscale.  Previews are kept
+in a disk cache of "--preview-cache" MiB, and those of all the input and
+processed files are rendered in the background unless "--no-prerender"
+is given.
+
+To simulate slow storage in load tests, "--delay PREFIX=DIST" delays
+the requests to a route (e.g. --delay /input/=lognormal:0.5:1), and
+"--bandwidth PREFIX=RATE" limits the speed of the files sent (e.g.
+--bandwidth /input/=2M).  With the async engine the delays do not hold
+any thread.  With the threads engine every delayed connection holds its
+own thread.  They are not available with the pool engine, whose fixed
+number of threads they would hold, changing the capacity being measured.
+
+New files in the input folder are detected with inotify (or scanned
+every "--poll-interval" seconds with "--poll-input"). When there are
+none, http://0.0.0.0:8080/get_task waits up to "--task-wait" seconds
+for one (less if the client asks for less with "?wait=N", and not at
+all with the async engine) and then answers "204 No Content".
+
+Finished tasks are reported with /end_task?task_id=... Their input
+files are moved to the processed folder in the background, and their
+status can be checked with /task_status?task_id=...
+
+The next "--prefetch-depth" files of the queue are read ahead into the
+page cache, so that they are read from memory when they are downloaded
+while the current tasks are processed.
+
+Several tasks can be requested at once with
+http://0.0.0.0:8080/get_tasks?n=K (up to "--max-batch"), and finished
+at once by passing several task_id arguments to /end_task.
+
+Each dispatched task holds a lease of "--lease-ttl" seconds, which the
+client extends with http://0.0.0.0:8080/heartbeat?task_id=... If the
+lease expires, the input file of the task is handed out again.
+Finished tasks are remembered for "--task-retention" seconds, even
+when leases are disabled with "--lease-ttl 0".
+
+With "--journal FILE", the queue, the running tasks and the finished
+tasks are recorded in FILE, and restored from it when the server is
+started again, so that finished work is not handed out again.
+
+To use several cores, "--workers N" starts N server processes that
+share the port and the queue of tasks. A supervisor process restarts
+any worker that dies.
+
 The default logging level is "info". You can change it using the
 "--level" option.
 
@@ -84,17 +153,38 @@ from time import gmtime, strftime, time, sleep
 import argparse
 import BaseHTTPServer
 import cgi
+import email.utils
 import logging
 import os
 import sys
 import urlparse
 import re
+import math
 import json
 import posixpath
+import random
+import zlib
 import mimetypes
 import urllib
 import shutil
-import glob
+import errno
+import fcntl
+import socket
+import tempfile
+import asyncore
+import asynchat
+import Queue
+import select
+import signal
+import struct
+import hashlib
+import heapq
+import itertools
+import collections
+import ctypes
+import ctypes.util
+import multiprocessing
+from multiprocessing.managers import BaseManager
 
 from SocketServer import ThreadingMixIn
 import threading
@@ -104,216 +194,3976 @@ try:
 except ImportError:
     from StringIO import StringIO
 
-from astropy.io import fits
-import numpy as np
+from astropy.io import fits
+from astropy.visualization import ZScaleInterval
+import numpy as np
+
+# Zero-copy transfers: os.sendfile (Python 3.3+) or the pysendfile
+# package, which provides the same call for Python 2
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+# Brotli is only needed to compress on the fly, precompressed .br files
+# are served without it
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Pillow is only needed for JPEG previews, PNG previews are encoded
+# without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Lets several worker processes listen on the same port.  The constant
+# is missing from the socket module of Python 2, but not from Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+# Block size used when files have to be copied through user space
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+def sync_directory(path):
+    '''
+    Flush to disk the changes of the entries of a directory, such as the
+    files renamed into or out of it
+    :param path: Path of the directory
+    :return: -
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def move_file(src, dst):
+    '''
+    Move a file atomically: the destination either does not exist or is
+    complete.  Across file systems, the file is copied next to its
+    destination, flushed to disk and renamed, and the source is removed.
+    :param src: Path of the file
+    :param dst: New path of the file
+    :return: -
+    '''
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = dst + '.part'
+        with open(src, 'rb') as ifp, open(tmp, 'wb') as ofp:
+            shutil.copyfileobj(ifp, ofp, COPY_CHUNK_SIZE)
+            ofp.flush()
+            os.fsync(ofp.fileno())
+        shutil.copystat(src, tmp)
+        os.rename(tmp, dst)
+        os.unlink(src)
+
+
+def parse_byte_ranges(header, size):
+    '''
+    Parse the value of a Range header for a resource of the given size.
+    Overlapping and adjacent ranges are merged.
+    :param header: Value of the Range header, e.g. "bytes=0-2879,-2880"
+    :param size: Size of the resource in bytes
+    :return: List of (first, last) byte positions (inclusive), an empty
+             list if no range can be satisfied, or None if the header is
+             not valid and must be ignored
+    '''
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not specs.strip():
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        if not sep:
+            return None
+        try:
+            if first == '':
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length == 0 or size == 0:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+            else:
+                first = int(first)
+                last = int(last) if last else max(first, size - 1)
+                if first < 0 or last < first:
+                    return None
+                if first >= size:
+                    continue
+                ranges.append((first, min(last, size - 1)))
+        except ValueError:
+            return None
+
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def parse_slice(value, size):
+    '''
+    Parse a START:STOP pixel range, as in Python slices without step
+    :param value: Range, either end may be omitted
+    :param size: Length of the axis
+    :return: (start, stop) within the axis
+    :raise ValueError: if the range is not valid or empty
+    '''
+    start, sep, stop = value.partition(':')
+    if not sep:
+        raise ValueError('Expected START:STOP: ' + value)
+    start, stop, _ = slice(int(start) if start.strip() else None,
+                           int(stop) if stop.strip() else None).indices(size)
+    if start >= stop:
+        raise ValueError('Empty range: ' + value)
+    return start, stop
+
+
+def make_etag(st):
+    '''
+    Make the strong entity tag of a file, from its inode, modification
+    time and size
+    :param st: os.stat result of the file
+    :return: Quoted entity tag
+    '''
+    return '"{:x}-{:x}-{:x}"'.format(st.st_ino, int(st.st_mtime * 1000000), st.st_size)
+
+
+def etag_matches(header, etag, weak=True):
+    '''
+    Check an entity tag against an If-None-Match or If-Range header
+    :param header: Value of the header: "*" or a list of entity tags
+    :param etag: Entity tag of the current file
+    :param weak: Whether weak tags (W/"...") match too
+    :return: Whether the header matches the entity tag
+    '''
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag:
+            return True
+        if weak and tag.startswith('W/') and tag[2:] == etag:
+            return True
+    return False
+
+
+def parse_http_date(value):
+    '''
+    Parse an HTTP date
+    :param value: Date, as in Last-Modified
+    :return: Seconds since the epoch, or None if it is not valid
+    '''
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    try:
+        return email.utils.mktime_tz(date)
+    except (OverflowError, ValueError, TypeError):
+        return None
+
+
+def parse_accept_encoding(header, supported):
+    '''
+    Parse an Accept-Encoding header
+    :param header: Value of the header
+    :param supported: Content codings supported, by order of preference
+    :return: The supported codings accepted by the client, the preferred
+             ones first
+    '''
+    qvalues = {}
+    for item in header.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    accepted = [(qvalues.get(enc, qvalues.get('*', 0.0)), -rank, enc)
+                for rank, enc in enumerate(supported)]
+    return [enc for weight, _rank, enc in sorted(accepted, reverse=True) if weight > 0]
+
+
+def make_compressor(coding):
+    '''
+    Make a streaming compressor
+    :param coding: Content coding, "gzip" or "br"
+    :return: (compress, finish) functions: compress(data) returns the
+             compressed data available so far, and finish() the rest
+    '''
+    if coding == 'br':
+        compressor = brotli.Compressor()
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+class LatencyInjector(object):
+    '''
+    Artificial delays and bandwidth limits of the responses, by route, to
+    simulate slow storage in load tests.  Delays are given as
+    PREFIX=DISTRIBUTION, where the distribution is one of:
+
+      S, fixed:S               always S seconds
+      uniform:A:B              between A and B seconds
+      normal:MU:SIGMA          normal, negative values count as 0
+      lognormal:MEDIAN:SIGMA   log-normal, long tail of slow requests
+      exp:MEAN                 exponential
+
+    and bandwidth limits as PREFIX=RATE in bytes per second, with an
+    optional K, M or G suffix.  The longest matching prefix of the path
+    applies, "*" matches any path.
+    '''
+    rate_units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+    def __init__(self, delays=(), rates=(), seed=None):
+        self.random = random.Random(seed)
+        self.delay_rules = sorted((self.parse_delay(spec) for spec in delays),
+                                  key=lambda rule: len(rule[0]), reverse=True)
+        self.rate_rules = sorted((self.parse_rate(spec) for spec in rates),
+                                 key=lambda rule: len(rule[0]), reverse=True)
+
+    @staticmethod
+    def split_rule(spec):
+        prefix, sep, value = spec.partition('=')
+        if not sep or not prefix or not value:
+            raise ValueError('Expected PREFIX=VALUE: ' + spec)
+        return ('' if prefix == '*' else prefix), value
+
+    def parse_delay(self, spec):
+        '''
+        Parse a delay rule
+        :param spec: PREFIX=DISTRIBUTION
+        :return: (prefix, function returning a delay in seconds)
+        :raise ValueError: if the rule is not valid
+        '''
+        prefix, value = self.split_rule(spec)
+        name, _, params = value.partition(':')
+        try:
+            if not params:
+                name, params = 'fixed', value
+            args = [float(arg) for arg in params.split(':')]
+        except ValueError:
+            raise ValueError('Invalid delay parameters: ' + spec)
+        samplers = {'fixed': (1, lambda s: s),
+                    'uniform': (2, self.random.uniform),
+                    'normal': (2, self.random.gauss),
+                    'lognormal': (2, lambda median, sigma: median * math.exp(self.random.gauss(0, sigma))),
+                    'exp': (1, lambda mean: self.random.expovariate(1.0 / mean) if mean > 0 else 0)}
+        if name not in samplers:
+            raise ValueError('Unknown delay distribution: ' + spec)
+        nargs, sampler = samplers[name]
+        if len(args) != nargs or min(args) < 0:
+            raise ValueError('Invalid delay parameters: ' + spec)
+        return prefix, lambda: max(sampler(*args), 0.0)
+
+    def parse_rate(self, spec):
+        '''
+        Parse a bandwidth rule
+        :param spec: PREFIX=RATE
+        :return: (prefix, bytes per second)
+        :raise ValueError: if the rule is not valid
+        '''
+        prefix, value = self.split_rule(spec)
+        unit = value[-1].upper() if value[-1].upper() in self.rate_units else ''
+        try:
+            rate = float(value[:len(value) - len(unit)]) * self.rate_units[unit]
+        except ValueError:
+            raise ValueError('Invalid bandwidth: ' + spec)
+        if rate <= 0:
+            raise ValueError('Invalid bandwidth: ' + spec)
+        return prefix, rate
+
+    @staticmethod
+    def match(rules, path):
+        path = urlparse.urlparse(path).path
+        for prefix, value in rules:
+            if path.startswith(prefix):
+                return value
+        return None
+
+    def delay(self, path):
+        '''
+        Draw the delay of a request
+        :param path: Path of the request
+        :return: Seconds to wait before handling it
+        '''
+        sampler = self.match(self.delay_rules, path)
+        return sampler() if sampler is not None else 0
+
+    def rate(self, path):
+        '''
+        Get the bandwidth limit of a request
+        :param path: Path of the request
+        :return: Bytes per second, or None if not limited
+        '''
+        return self.match(self.rate_rules, path)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ This class allows to handle requests in separated threads.
+        No further content needed, don't touch this. """
+    # Threads of idle persistent connections or waiting for a task do
+    # not keep the server running once it is stopped
+    daemon_threads = True
+
+
+class PoolHTTPServer(BaseHTTPServer.HTTPServer):
+    '''
+    HTTP server that hands accepted connections to a fixed number of
+    worker threads through a bounded queue.  When the queue is full the
+    connection is answered at once with 503 and a Retry-After header,
+    instead of piling up threads.  Persistent connections only keep
+    their worker while no other connection is waiting for one.
+    '''
+    request_queue_size = 128
+    # Seconds between checks of the queue while a connection is idle
+    idle_check_interval = 0.1
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True,
+                 pool_size=16, queue_depth=64, retry_after=1):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass,
+                                           bind_and_activate)
+        self.pool_size = pool_size
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+        self.requests = Queue.Queue(queue_depth)
+        self.stats_lock = threading.Lock()
+        self.served = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.workers = []
+        for i in range(pool_size):
+            worker = threading.Thread(target=self.process_request_worker,
+                                      name='pool-worker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address, time()))
+        except Queue.Full:
+            self.reject_request(request, client_address)
+
+    def reject_request(self, request, client_address):
+        '''
+        Answer a connection with 503 Service Unavailable without reading
+        the request, and close it
+        '''
+        with self.stats_lock:
+            self.rejected += 1
+        logging.warning('Server saturated, rejecting connection from {}'.format(client_address[0]))
+        body = 'Server busy, retry later.\n'
+        try:
+            request.settimeout(1.0)
+            request.sendall('HTTP/1.0 503 Service Unavailable\r\n'
+                            'Retry-After: {}\r\n'
+                            'Content-Type: text/plain\r\n'
+                            'Content-Length: {}\r\n'
+                            'Connection: close\r\n\r\n{}'.format(self.retry_after, len(body), body))
+            # Drain what the client already sent, so that closing the
+            # socket does not reset the connection before it reads the 503
+            request.setblocking(0)
+            while request.recv(COPY_CHUNK_SIZE):
+                pass
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            request, client_address, queued = item
+            wait = time() - queued
+            with self.stats_lock:
+                self.served += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def busy(self):
+        '''
+        Check whether connections are waiting for a worker
+        '''
+        return not self.requests.empty()
+
+    def wait_for_request(self, connection, timeout):
+        '''
+        Wait for the next request of a persistent connection, unless other
+        connections are waiting for the worker
+        :param connection: Socket of the connection
+        :param timeout: Idle timeout, in seconds, None for no limit
+        :return: Whether a request can be read, False if the connection
+                 should be closed
+        '''
+        deadline = time() + timeout if timeout else None
+        while not self.busy():
+            wait = self.idle_check_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time())
+                if wait <= 0:
+                    return False
+            if select.select([connection], [], [], wait)[0]:
+                return True
+        return False
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {'pool_size': self.pool_size,
+                    'queue_depth': self.queue_depth,
+                    'queued': self.requests.qsize(),
+                    'served': self.served,
+                    'rejected': self.rejected,
+                    'queue_wait_avg': self.wait_total / self.served if self.served else 0.0,
+                    'queue_wait_max': self.wait_max}
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        for _ in self.workers:
+            self.requests.put(None)
+
+
+class FileProducer(object):
+    '''
+    asynchat producer that sends a byte range of a file in chunks, so
+    that the event loop never blocks on a large transfer.
+    '''
+    block_size = 256 * 1024
+
+    def __init__(self, fd, offset, count):
+        self.ifp = os.fdopen(fd, 'rb')
+        self.ifp.seek(offset)
+        self.remaining = count
+
+    def more(self):
+        if self.remaining > 0:
+            data = self.ifp.read(min(self.block_size, self.remaining))
+            if data:
+                self.remaining -= len(data)
+                return data
+        self.remaining = 0
+        self.ifp.close()
+        return ''
+
+
+class BufferProducer(object):
+    '''
+    asynchat producer that sends a byte range of a string in blocks,
+    without copying it.
+    '''
+    block_size = FileProducer.block_size
+
+    def __init__(self, data, offset, count):
+        self.data = data
+        self.offset = offset
+        self.end = offset + count
+
+    def more(self):
+        if self.offset >= self.end:
+            return ''
+        data = buffer(self.data, self.offset, min(self.block_size, self.end - self.offset))
+        self.offset += len(data)
+        return data
+
+
+class ArrayProducer(object):
+    '''
+    asynchat producer that sends the rows of an array a block at a time,
+    so that a memory mapped image is only read as it is sent.
+    '''
+
+    def __init__(self, data, block_rows):
+        self.data = data
+        self.block_rows = block_rows
+        self.row = 0
+
+    def more(self):
+        if self.row >= self.data.shape[0]:
+            return ''
+        data = self.data[self.row:self.row + self.block_rows].tobytes()
+        self.row += self.block_rows
+        return data
+
+
+class ChannelWriter(object):
+    '''
+    File-like object used as wfile by the asynchronous handlers.  Writes
+    are buffered and queued in the channel at once when flushed.
+    '''
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.buffer = []
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    def flush(self):
+        if self.buffer:
+            self.channel.push(''.join(self.buffer))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class AsyncHandlerMixin:
+    '''
+    Mix-in that runs a request handler on a request already read by an
+    AsyncHTTPChannel, instead of on a blocking socket.
+    '''
+    # Waiting would block the event loop
+    long_poll = False
+
+    def setup(self):
+        self.connection = self.request
+        self.rfile = self.request.request_file
+        self.wfile = ChannelWriter(self.request)
+
+    def handle(self):
+        # The channel holds exactly one request, it decides itself
+        # whether the connection is kept open afterwards
+        self.close_connection = 1
+        self.handle_one_request()
+
+    def finish(self):
+        self.wfile.flush()
+        self.rfile.close()
+
+    def address_string(self):
+        # Avoid a blocking reverse DNS lookup in the event loop
+        return self.client_address[0]
+
+    def injected_delay(self):
+        # Already waited for by the channel, without blocking
+        return 0
+
+    def injected_rate(self):
+        # The channel paces its output
+        return None
+
+    def stream_file(self, ifp, offset, count):
+        self.wfile.flush()
+        self.connection.push_with_producer(FileProducer(os.dup(ifp.fileno()), offset, count))
+
+    def send_cached(self, data, offset, count):
+        self.wfile.flush()
+        self.connection.push_with_producer(BufferProducer(data, offset, count))
+
+    def stream_array(self, data, block_rows):
+        self.wfile.flush()
+        self.connection.push_with_producer(ArrayProducer(data, block_rows))
+
+    def wait_result(self, start, respond):
+        # The event loop goes on, the response is sent from it when the
+        # result is ready
+        self.deferred = True
+        start(lambda result, error: self.server.call_from_thread(
+            lambda: self.send_deferred(respond, result, error)))
+
+    def send_deferred(self, respond, result, error):
+        '''
+        Send the response of a deferred request, from the event loop
+        '''
+        if not self.connection.connected:
+            return
+        try:
+            respond(result, error)
+            self.wfile.flush()
+        except Exception:
+            logging.exception('Error handling request from {}'.format(self.client_address[0]))
+            self.connection.close()
+            return
+        self.connection.request_done(self.close_connection)
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    '''
+    Connection of the event-driven server.  It reads the request line,
+    headers and body without blocking, and then runs the request handler
+    on them.  Request bodies larger than spool_size are kept on disk.
+    '''
+    max_header_size = 65536
+    spool_size = 1024 * 1024
+    ac_in_buffer_size = COPY_CHUNK_SIZE
+    ac_out_buffer_size = FileProducer.block_size
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock=sock, map=server.socket_map)
+        # Responses to pipelined requests are sent one after the other
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.addr = addr
+        self.last_activity = time()
+        # Injected latency: whether a request is waiting for its delay,
+        # and the output bandwidth limit with the time of the next send
+        self.delayed = False
+        self.pending_input = ''
+        self.rate = None
+        self.send_after = 0
+        self.server.channels.add(self)
+        self.reset()
+
+    def reset(self):
+        self.request_file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self.header_size = 0
+        self.reading_body = False
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time()
+        self.request_file.write(data)
+        if not self.reading_body:
+            self.header_size += len(data)
+            if self.header_size > self.max_header_size:
+                logging.warning('Request header too large from {}'.format(self.addr[0]))
+                self.close()
+
+    def found_terminator(self):
+        if not self.reading_body:
+            self.request_file.write('\r\n\r\n')
+            length = self.content_length()
+            if length > 0:
+                self.reading_body = True
+                self.set_terminator(length)
+                return
+        self.dispatch()
+
+    def content_length(self):
+        self.request_file.seek(0)
+        match = re.search(r'^content-length:\s*(\d+)', self.request_file.read(),
+                          re.IGNORECASE | re.MULTILINE)
+        return int(match.group(1)) if match else 0
+
+    def dispatch(self):
+        latency = self.server.RequestHandlerClass.m_latency
+        if latency is not None and not self.delayed:
+            self.request_file.seek(0)
+            path = (self.request_file.readline().split() + ['', ''])[1]
+            self.rate = latency.rate(path)
+            delay = latency.delay(path)
+            if delay > 0:
+                # Nothing more is read until the request is handled, and
+                # the pipelined requests already read wait for it as well
+                self.delayed = True
+                self.pending_input, self.ac_in_buffer = self.ac_in_buffer, ''
+                self.server.call_later(delay, self.dispatch)
+                return
+        if not self.connected:
+            return
+        self.request_file.seek(0)
+        try:
+            handler = self.server.RequestHandlerClass(self, self.addr, self.server)
+        except Exception:
+            logging.exception('Error handling request from {}'.format(self.addr[0]))
+            self.close()
+            return
+        if handler.deferred:
+            # The response is sent later (see AsyncHandlerMixin.wait_result),
+            # the pipelined requests wait for it
+            self.delayed = True
+            self.pending_input, self.ac_in_buffer = self.ac_in_buffer + self.pending_input, ''
+            return
+        self.request_done(handler.close_connection)
+
+    def request_done(self, close):
+        '''
+        Go on with the next request once a response is queued
+        :param close: Whether the connection is closed after the response
+        :return: -
+        '''
+        if close:
+            self.close_when_done()
+        else:
+            self.reset()
+            if self.delayed:
+                self.delayed = False
+                if self.pending_input:
+                    self.handle_read()
+
+    def recv(self, buffer_size):
+        # Input put aside while a request was delayed is read first
+        if self.pending_input:
+            data, self.pending_input = self.pending_input, ''
+            return data
+        return asynchat.async_chat.recv(self, buffer_size)
+
+    def readable(self):
+        return not self.delayed and asynchat.async_chat.readable(self)
+
+    def writable(self):
+        if self.rate is not None and self.send_after > time():
+            return False
+        return asynchat.async_chat.writable(self)
+
+    def send(self, data):
+        if self.rate is None:
+            return asynchat.async_chat.send(self, data)
+        # Send at most a tenth of a second worth of data at once, and
+        # wait until the time it would take at the limited rate
+        data = buffer(data, 0, max(int(self.rate / 10), 1024))
+        sent = asynchat.async_chat.send(self, data)
+        if sent:
+            self.send_after = max(self.send_after, time()) + sent / self.rate
+            self.server.call_later(self.send_after - time(), lambda: None)
+        return sent
+
+    def handle_write(self):
+        self.last_activity = time()
+        asynchat.async_chat.handle_write(self)
+
+    def close(self):
+        self.server.channels.discard(self)
+        asynchat.async_chat.close(self)
+
+
+class LoopWaker(asyncore.file_dispatcher):
+    '''
+    Pipe that wakes up the event loop of an AsyncHTTPServer to run
+    functions passed by other threads
+    '''
+
+    def __init__(self, socket_map):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+        # file_dispatcher works on a copy of the descriptor
+        os.close(read_fd)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, fcntl.fcntl(self.write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def call(self, function):
+        with self.lock:
+            self.calls.append(function)
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError as e:
+            # The pipe is full, the loop is woken up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        with self.lock:
+            calls, self.calls = self.calls, []
+        for function in calls:
+            try:
+                function()
+            except Exception:
+                logging.exception('Error in the event loop')
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    '''
+    Event-driven alternative to ThreadedHTTPServer: a single thread
+    multiplexes all the connections with poll(), so idle keep-alive
+    connections only cost a socket and a small buffer each.
+    '''
+    request_queue_size = 1024
+    # Seconds without accepting connections when out of file descriptors
+    accept_backoff = 0.5
+
+    def __init__(self, server_address, RequestHandlerClass, idle_timeout=60, reuse_port=False):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        if reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.bind(server_address)
+        self.listen(self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.idle_timeout = idle_timeout
+        self.channels = set()
+        # Heap of (time, sequence, function) to call from the event loop
+        self.timers = []
+        self.timer_counter = itertools.count()
+        self.waker = LoopWaker(self.socket_map)
+        self.accept_after = 0
+
+        class AsyncQLARqstHandler(AsyncHandlerMixin, RequestHandlerClass):
+            pass
+        self.RequestHandlerClass = AsyncQLARqstHandler
+
+    def readable(self):
+        return time() >= self.accept_after
+
+    def handle_accept(self):
+        try:
+            pair = self.accept()
+        except socket.error as e:
+            if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                raise
+            # The pending connections wait in the backlog until
+            # descriptors are released
+            logging.warning('Cannot accept connections: {}, retrying in {} s'.format(
+                os.strerror(e.errno), self.accept_backoff))
+            self.accept_after = time() + self.accept_backoff
+            self.call_later(self.accept_backoff, lambda: None)
+            return
+        if pair is not None:
+            sock, addr = pair
+            AsyncHTTPChannel(self, sock, addr)
+
+    def handle_error(self):
+        # The default handler would close the listening socket
+        logging.exception('Error accepting a connection')
+
+    def close_idle_channels(self):
+        deadline = time() - self.idle_timeout
+        for channel in list(self.channels):
+            if channel.last_activity < deadline and not channel.producer_fifo and not channel.delayed:
+                logging.debug('Closing idle connection from {}'.format(channel.addr[0]))
+                channel.close()
+
+    def get_stats(self):
+        return {'connections': len(self.channels)}
+
+    def call_later(self, delay, function):
+        '''
+        Call a function from the event loop after some time
+        :param delay: Seconds to wait
+        :param function: Function without arguments
+        :return: -
+        '''
+        heapq.heappush(self.timers, (time() + delay, next(self.timer_counter), function))
+
+    def call_from_thread(self, function):
+        '''
+        Call a function from the event loop, as soon as possible.  It can
+        be called from any thread.
+        :param function: Function without arguments
+        :return: -
+        '''
+        self.waker.call(function)
+
+    def run_timers(self):
+        now = time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, function = heapq.heappop(self.timers)
+            function()
+
+    def serve_forever(self):
+        while True:
+            timeout = 1.0
+            if self.timers:
+                timeout = min(max(self.timers[0][0] - time(), 0), timeout)
+            asyncore.loop(timeout=timeout, use_poll=True, map=self.socket_map, count=1)
+            self.run_timers()
+            self.close_idle_channels()
+
+    def server_close(self):
+        for channel in list(self.channels):
+            channel.close()
+        self.waker.close()
+        self.close()
+
+
+class ContentCache(object):
+    '''
+    Thread-safe LRU cache of the contents of the files served, limited to
+    max_bytes in total.  Entries are checked against the modification
+    time and size of the file, so a file that changed is read again.
+    Files larger than max_file_bytes are not cached.
+    '''
+
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.lock = threading.Lock()
+        # Path: (mtime, size, contents), least recently used first
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, st):
+        '''
+        Get the cached contents of a file
+        :param key: Path of the file, or (path, coding) for its
+                    compressed contents
+        :param st: Current os.stat result of the file
+        :return: Contents of the file, or None if not cached or outdated
+        '''
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                if entry[:2] == (st.st_mtime, st.st_size):
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[2]
+                self.size -= len(entry[2])
+            self.misses += 1
+            return None
+
+    def load(self, path, ifp, st):
+        '''
+        Read a file into the cache, if it is small enough
+        :param path: Path of the file
+        :param ifp: File object open for reading
+        :param st: os.fstat result of the open file
+        :return: Contents of the file, or None if it is not cached
+        '''
+        if st.st_size > self.max_file_bytes:
+            return None
+        ifp.seek(0)
+        data = ifp.read(st.st_size + 1)
+        if len(data) != st.st_size:
+            # Being written
+            return None
+        self.put(path, st, data)
+        return data
+
+    def put(self, key, st, data):
+        '''
+        Cache contents derived from a file, if they are small enough
+        :param key: Key of the contents
+        :param st: os.stat result of the file they come from
+        :param data: Contents
+        :return: -
+        '''
+        if len(data) > self.max_file_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self.entries[key] = (st.st_mtime, st.st_size, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, _, old_data) = self.entries.popitem(last=False)
+                self.size -= len(old_data)
+                self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'files': len(self.entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes}
+
+
+def compute_image_stats(data, bins, sigma, iterations):
+    '''
+    Compute the statistics of an image, vectorized
+    :param data: Image array, as stored (not scaled)
+    :param bins: Number of bins of the histogram
+    :param sigma: Clipping threshold, in standard deviations
+    :param iterations: Maximum number of clipping iterations
+    :return: Dictionary of statistics, of the stored values
+    '''
+    values = np.asarray(data).ravel()
+    if values.dtype.kind == 'f':
+        values = values[np.isfinite(values)]
+    if values.size == 0:
+        return {'count': 0}
+    stats = {'count': int(values.size),
+             'min': float(values.min()),
+             'max': float(values.max()),
+             'mean': float(values.mean(dtype=np.float64)),
+             'median': float(np.median(values)),
+             'std': float(values.std(dtype=np.float64))}
+
+    clipped = values
+    for iteration in range(1, iterations + 1):
+        center = np.median(clipped)
+        std = clipped.std(dtype=np.float64)
+        kept = clipped[np.abs(clipped - center) <= sigma * std]
+        if kept.size == clipped.size or kept.size == 0:
+            break
+        clipped = kept
+    stats['clipped'] = {'count': int(clipped.size),
+                        'mean': float(clipped.mean(dtype=np.float64)),
+                        'median': float(np.median(clipped)),
+                        'std': float(clipped.std(dtype=np.float64)),
+                        'sigma': sigma,
+                        'iterations': iteration}
+
+    counts, edges = np.histogram(values, bins=bins, range=(stats['min'], stats['max']))
+    stats['histogram'] = {'counts': counts.tolist(), 'edges': edges.tolist()}
+    return stats
+
+
+def compute_fits_stats(path, hdu_key, bins, sigma, iterations):
+    '''
+    Compute the statistics of the image HDUs of a FITS file, memory
+    mapped.  Run in the processes of QuickLookStats.
+    :param path: Full path of the file
+    :param hdu_key: Index or name of a single HDU, or None for all
+    :param bins: Number of bins of the histograms
+    :param sigma: Clipping threshold, in standard deviations
+    :param iterations: Maximum number of clipping iterations
+    :return: List of statistics by HDU, of the physical values
+    :raise KeyError: if the HDU does not exist
+    '''
+    results = []
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        if hdu_key is None:
+            indices = range(len(hdul))
+        else:
+            try:
+                indices = [int(hdu_key) if hdu_key.isdigit() else hdul.index_of(hdu_key)]
+                hdul[indices[0]]
+            except IndexError:
+                raise KeyError(hdu_key)
+        for index in indices:
+            hdu = hdul[index]
+            if not isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) or not hdu.header.get('NAXIS'):
+                continue
+            stats = compute_image_stats(hdu.data, bins, sigma, iterations)
+            # Stored values are scaled to the physical ones afterwards,
+            # which is cheaper than scaling every pixel
+            bscale = hdu.header.get('BSCALE', 1.0)
+            bzero = hdu.header.get('BZERO', 0.0)
+            if (bscale, bzero) != (1.0, 0.0):
+                for group in (stats, stats.get('clipped', {})):
+                    for key in ('min', 'max', 'mean', 'median'):
+                        if key in group:
+                            group[key] = group[key] * bscale + bzero
+                    if 'std' in group:
+                        group['std'] *= abs(bscale)
+                if 'histogram' in stats:
+                    stats['histogram']['edges'] = [edge * bscale + bzero
+                                                   for edge in stats['histogram']['edges']]
+            stats.update({'index': index, 'name': hdu.name, 'bitpix': hdu.header['BITPIX'],
+                          'shape': list(hdu.data.shape)})
+            results.append(stats)
+    return results
+
+
+def try_compute_fits_stats(*args):
+    '''
+    Call compute_fits_stats, returning its error instead of raising it,
+    since the callbacks of Pool.apply_async are not called on errors
+    :return: (statistics, None), or (None, exception)
+    '''
+    try:
+        return compute_fits_stats(*args), None
+    except (KeyError, EnvironmentError, ValueError) as e:
+        return None, e
+    except Exception as e:
+        # May not be picklable
+        return None, ValueError(str(e))
+
+
+class QuickLookStats(object):
+    '''
+    Statistics of the FITS files served, computed by a pool of processes
+    so that the number crunching does not hold the GIL of the server
+    threads.  Results are cached by file, modification time, size and
+    parameters, and concurrent requests for the same results share the
+    same computation.
+    '''
+    max_cached = 256
+    clip_iterations = 5
+
+    def __init__(self, processes):
+        self.pool = multiprocessing.Pool(processes, init_helper_process) if processes > 0 else None
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_async(self, path, hdu_key, bins, sigma, callback):
+        '''
+        Get the statistics of a file, without waiting for them
+        :param path: Full path of the file
+        :param hdu_key: Index or name of a single HDU, or None for all
+        :param bins: Number of bins of the histograms
+        :param sigma: Clipping threshold, in standard deviations
+        :param callback: Function called with the statistics (see get)
+                         and None, or None and the error, from any thread
+        :return: -
+        :raise OSError: if the file does not exist
+        '''
+        st = os.stat(path)
+        key = (path, st.st_mtime, st.st_size, hdu_key, bins, sigma)
+        args = (path, hdu_key, bins, sigma, self.clip_iterations)
+        with self.lock:
+            results = self.results.pop(key, None)
+            if results is not None:
+                self.hits += 1
+                self.results[key] = results
+            else:
+                self.misses += 1
+                # Concurrent requests share the same computation
+                callbacks = self.pending.get(key)
+                if callbacks is not None:
+                    callbacks.append(callback)
+                    return
+                self.pending[key] = [callback]
+        if results is not None:
+            callback(results, None)
+        elif self.pool is not None:
+            self.pool.apply_async(try_compute_fits_stats, args,
+                                  callback=lambda outcome: self.computed(key, *outcome))
+        else:
+            self.computed(key, *try_compute_fits_stats(*args))
+
+    def computed(self, key, results, error):
+        '''
+        Cache the result of a computation and pass it to its callbacks
+        '''
+        with self.lock:
+            callbacks = self.pending.pop(key)
+            if error is None:
+                self.results[key] = results
+                while len(self.results) > self.max_cached:
+                    self.results.popitem(last=False)
+        for callback in callbacks:
+            callback(results, error)
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'cached': len(self.results),
+                    'computing': len(self.pending)}
+
+
+def encode_png(pixels):
+    '''
+    Encode an 8-bit grayscale image as PNG
+    :param pixels: 2-D uint8 array, first row at the top
+    :return: PNG file contents
+    '''
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    height, width = pixels.shape
+    # Every row starts with its filter type, 0 (none)
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels
+    return ('\x89PNG\r\n\x1a\n' +
+            chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows.tobytes(), 6)) +
+            chunk('IEND', ''))
+
+
+def render_preview(path, preview_path, hdu_key, size, fmt):
+    '''
+    Render the preview of an image HDU of a FITS file: the image is
+    reduced by averaging blocks of pixels to at most size pixels on its
+    longest side, and stretched with zscale.  Run in the processes of
+    PreviewCache.
+    :param path: Full path of the FITS file
+    :param preview_path: Path of the preview written
+    :param hdu_key: Index or name of the HDU, or None for the first 2-D
+                    image HDU
+    :param size: Maximum width and height of the preview
+    :param fmt: png or jpeg
+    :return: Size of the preview, in bytes
+    :raise KeyError: if the HDU does not exist
+    :raise ValueError: if the HDU is not a 2-D image
+    '''
+    # Scaling (BSCALE/BZERO) is linear, so it does not change the
+    # stretched image and is not applied
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        if hdu_key is None:
+            images = [hdu for hdu in hdul
+                      if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and hdu.header.get('NAXIS') == 2]
+            if not images:
+                raise ValueError('No 2-D image HDU')
+            hdu = images[0]
+        else:
+            try:
+                hdu = hdul[int(hdu_key) if hdu_key.isdigit() else hdul.index_of(hdu_key)]
+            except IndexError:
+                raise KeyError(hdu_key)
+            if not isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) or hdu.header.get('NAXIS') != 2:
+                raise ValueError('HDU {} is not a 2-D image'.format(hdu_key))
+        data = hdu.data
+        factor = max(-(-max(data.shape) // size), 1)
+        rows, cols = data.shape[0] // factor, data.shape[1] // factor
+        if factor > 1:
+            # Block by block of rows, so that the image is not converted
+            # to float at once
+            image = np.empty((rows, cols), dtype=np.float32)
+            block_rows = max(COPY_CHUNK_SIZE * 16 // (data.strides[0] * factor), 1)
+            for row in range(0, rows, block_rows):
+                block = data[row * factor:min(row + block_rows, rows) * factor, :cols * factor]
+                image[row:row + block_rows] = block.reshape(-1, factor, cols, factor).mean(axis=(1, 3))
+        else:
+            image = data.astype(np.float32)
+
+    finite = np.isfinite(image)
+    if finite.any():
+        vmin, vmax = ZScaleInterval().get_limits(image[finite])
+    else:
+        vmin = vmax = 0
+    image[~finite] = vmin
+    scaled = (image - vmin) * (255.0 / max(vmax - vmin, 1e-30))
+    # FITS images have their first row at the bottom
+    pixels = np.flipud(np.clip(scaled, 0, 255).astype(np.uint8))
+    if fmt == 'jpeg':
+        output = StringIO()
+        Image.fromarray(pixels, 'L').save(output, 'JPEG', quality=85)
+        contents = output.getvalue()
+    else:
+        contents = encode_png(pixels)
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=os.path.dirname(preview_path))
+    try:
+        with os.fdopen(fd, 'wb') as ofp:
+            ofp.write(contents)
+        os.rename(tmp_path, preview_path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    return len(contents)
+
+
+def try_render_preview(*args):
+    '''
+    Call render_preview, returning its error instead of raising it (see
+    try_compute_fits_stats)
+    :return: (size of the preview, None), or (None, exception)
+    '''
+    try:
+        return render_preview(*args), None
+    except (KeyError, EnvironmentError, ValueError) as e:
+        return None, e
+    except Exception as e:
+        return None, ValueError(str(e))
+
+
+class PreviewCache(object):
+    '''
+    Disk cache of the previews of the FITS files, limited to max_bytes,
+    rendered by a pool of processes.  Previews are named after the file
+    name, modification time and size of their FITS file, so they are
+    still valid when the file is moved to the processed folder, and a
+    file that changed gets new ones.  The least recently used previews
+    are removed first; the cache folder can be shared by several server
+    processes.
+    '''
+    formats = collections.OrderedDict([('png', ('.png', 'image/png'))])
+    if Image is not None:
+        formats['jpeg'] = ('.jpg', 'image/jpeg')
+
+    def __init__(self, path, max_bytes, processes):
+        self.path = path
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                # Created by another server process
+                if e.errno != errno.EEXIST:
+                    raise
+        self.pool = multiprocessing.Pool(processes, init_helper_process) if processes > 0 else None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.trim()
+
+    def preview_path(self, file_name, st, hdu_key, size, fmt):
+        key = '{}:{!r}:{}:{}:{}'.format(file_name, st.st_mtime, st.st_size, hdu_key, size)
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + self.formats[fmt][0])
+
+    def is_cached(self, path, hdu_key, size, fmt):
+        '''
+        Check whether the preview of a FITS file is cached, without
+        marking it as used
+        '''
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return os.path.exists(self.preview_path(os.path.basename(path), st, hdu_key, size, fmt))
+
+    def get(self, path, hdu_key, size, fmt):
+        '''
+        Get the preview of a FITS file, waiting for it to be rendered if
+        it is not cached
+        :return: Path of the preview
+        :raise KeyError: if the HDU does not exist
+        :raise ValueError: if the HDU is not a 2-D image
+        :raise IOError: if the file cannot be read
+        '''
+        done = threading.Event()
+        outcome = []
+
+        def callback(preview_path, error):
+            outcome.append((preview_path, error))
+            done.set()
+
+        self.get_async(path, hdu_key, size, fmt, callback)
+        done.wait()
+        preview_path, error = outcome[0]
+        if error is not None:
+            raise error
+        return preview_path
+
+    def get_async(self, path, hdu_key, size, fmt, callback):
+        '''
+        Get the preview of a FITS file, rendering it if it is not cached,
+        without waiting for it
+        :param path: Full path of the FITS file
+        :param hdu_key: Index or name of the HDU, or None for the first
+                        2-D image HDU
+        :param size: Maximum width and height of the preview
+        :param fmt: png or jpeg
+        :param callback: Function called with the path of the preview and
+                         None, or None and the error (KeyError if the HDU
+                         does not exist, ValueError if it is not a 2-D
+                         image, IOError if the file cannot be read), from
+                         any thread
+        :return: -
+        :raise OSError: if the file does not exist
+        '''
+        st = os.stat(path)
+        preview_path = self.preview_path(os.path.basename(path), st, hdu_key, size, fmt)
+        try:
+            # The access time orders the previews for eviction, the
+            # modification time is left for the entity tag
+            os.utime(preview_path, (time(), os.stat(preview_path).st_mtime))
+            with self.lock:
+                self.hits += 1
+            callback(preview_path, None)
+            return
+        except OSError:
+            pass
+        args = (path, preview_path, hdu_key, size, fmt)
+        with self.lock:
+            self.misses += 1
+            # Concurrent requests share the same rendering
+            callbacks = self.pending.get(preview_path)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return
+            self.pending[preview_path] = [callback]
+        if self.pool is not None:
+            self.pool.apply_async(try_render_preview, args,
+                                  callback=lambda outcome: self.rendered(preview_path, *outcome))
+        else:
+            self.rendered(preview_path, *try_render_preview(*args))
+
+    def rendered(self, preview_path, nbytes, error):
+        '''
+        Account for a rendered preview and pass it to its callbacks
+        '''
+        with self.lock:
+            callbacks = self.pending.pop(preview_path)
+            if error is None:
+                self.size += nbytes
+            full = self.size > self.max_bytes
+        if full:
+            self.trim(keep=preview_path)
+        for callback in callbacks:
+            callback(preview_path if error is None else None, error)
+
+    def trim(self, keep=None):
+        '''
+        Remove the least recently used previews until the cache fits in
+        max_bytes, and count its size again, with the previews of the
+        other processes
+        :param keep: Path of a preview not to remove
+        :return: -
+        '''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.part'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, name))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if os.path.join(self.path, name) == keep:
+                continue
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+            evicted += 1
+        with self.lock:
+            self.size = total
+            self.evictions += evicted
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'rendering': len(self.pending),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes}
+
+
+class PreviewPipeline(threading.Thread):
+    '''
+    Thread that renders in the background the previews of the FITS files
+    in the input and processed folders, so that they are cached when they
+    are asked for.  It renders those of the files already there when it
+    starts, and then those of the files submitted by the TaskStore as
+    they arrive or are processed, newest first.  Previews are rendered
+    one at a time, so that the pipeline uses a single process of its
+    PreviewCache.
+    '''
+
+    def __init__(self, previews, folders, size, fmt):
+        threading.Thread.__init__(self, name='preview-pipeline')
+        self.daemon = True
+        self.previews = previews
+        self.folders = folders
+        self.size = size
+        self.fmt = fmt
+        self.files = Queue.LifoQueue()
+
+    def submit(self, file_names):
+        '''
+        Queue files for rendering
+        :param file_names: Names of the files, in the input or processed
+                           folder
+        :return: -
+        '''
+        for file_name in file_names:
+            self.files.put(file_name)
+
+    def list_files(self):
+        '''
+        List the files of the folders, oldest first
+        '''
+        files = []
+        for folder in self.folders:
+            try:
+                names = [name for name in os.listdir(folder) if name.endswith('.fits')]
+            except OSError:
+                continue
+            for name in names:
+                try:
+                    files.append((os.path.getmtime(os.path.join(folder, name)), name))
+                except OSError:
+                    continue
+        return [name for _, name in sorted(files)]
+
+    def find(self, file_name):
+        '''
+        Get the full path of a file, which may have been moved to the
+        processed folder meanwhile
+        :return: Path of the file, or None if it is gone
+        '''
+        for folder in self.folders:
+            path = os.path.join(folder, file_name)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def run(self):
+        logging.info('Rendering the previews of the files in {}'.format(', '.join(self.folders)))
+        self.submit(self.list_files())
+        while True:
+            file_name = self.files.get()
+            path = self.find(file_name)
+            if path is None or self.previews.is_cached(path, None, self.size, self.fmt):
+                continue
+            try:
+                self.previews.get(path, None, self.size, self.fmt)
+            except (KeyError, ValueError, IOError, OSError) as e:
+                logging.debug('No preview of {}: {}'.format(file_name, e))
+
+
+class InputWatcher(threading.Thread):
+    '''
+    Thread that feeds the FITS files arriving in the input folder to a
+    TaskStore.  It is woken up by inotify where available (Linux), and
+    scans the folder every poll_interval seconds otherwise.
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    event_header = struct.Struct('iIII')
+
+    def __init__(self, tasks, path, poll_interval=2.0, use_inotify=True):
+        threading.Thread.__init__(self, name='input-watcher')
+        self.daemon = True
+        self.tasks = tasks
+        self.path = path
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.seen = set()
+
+    def list_input_files(self):
+        try:
+            return set(name for name in os.listdir(self.path) if name.endswith('.fits'))
+        except OSError:
+            return set()
+
+    def scan(self):
+        '''
+        Synchronize the known files with the contents of the folder
+        '''
+        current = self.list_input_files()
+        new_files = sorted(current - self.seen)
+        for name in self.seen - current:
+            self.tasks.remove_input_file(name)
+        self.seen = current
+        if new_files:
+            self.tasks.add_input_files(new_files)
+
+    def inotify_init(self):
+        '''
+        Set an inotify watch on the folder
+        :return: inotify file descriptor, or None if not available
+        '''
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        if libc.inotify_add_watch(fd, self.path, mask) < 0:
+            logging.warning('Cannot watch {}: {}'.format(self.path, os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return None
+        return fd
+
+    def run(self):
+        fd = self.inotify_init() if self.use_inotify else None
+        if self.seen:
+            self.tasks.index_input_files(sorted(self.seen))
+        self.scan()
+        if fd is None:
+            logging.info('Scanning {} every {} s for new files'.format(self.path, self.poll_interval))
+            self.poll()
+        else:
+            logging.info('Watching {} for new files'.format(self.path))
+            self.watch(fd)
+
+    def poll(self):
+        # A new file is only taken once its size did not change
+        # between two scans, so that it is not handed out half written
+        sizes = {}
+        while True:
+            sleep(self.poll_interval)
+            current = self.list_input_files()
+            for name in self.seen - current:
+                self.tasks.remove_input_file(name)
+            self.seen &= current
+            new_files = []
+            new_sizes = {}
+            for name in sorted(current - self.seen):
+                try:
+                    size = os.path.getsize(os.path.join(self.path, name))
+                except OSError:
+                    continue
+                if sizes.get(name) == size:
+                    new_files.append(name)
+                    self.seen.add(name)
+                else:
+                    new_sizes[name] = size
+            sizes = new_sizes
+            if new_files:
+                self.tasks.add_input_files(new_files)
+
+    def watch(self, fd):
+        while True:
+            buf = os.read(fd, COPY_CHUNK_SIZE)
+            offset = 0
+            new_files = []
+            while offset < len(buf):
+                _, mask, _, length = self.event_header.unpack_from(buf, offset)
+                offset += self.event_header.size
+                name = buf[offset:offset + length].rstrip('\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    # Events were lost
+                    self.scan()
+                elif not name.endswith('.fits'):
+                    continue
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    if name not in self.seen:
+                        self.seen.add(name)
+                        new_files.append(name)
+                elif name in self.seen:
+                    self.seen.discard(name)
+                    if name in new_files:
+                        new_files.remove(name)
+                    else:
+                        self.tasks.remove_input_file(name)
+            if new_files:
+                self.tasks.add_input_files(new_files)
+
+
+class MultipartReader(object):
+    '''
+    Streaming parser of multipart/form-data request bodies.  The body is
+    read in fixed-size blocks that are scanned for the part delimiters,
+    and the content of every part is written to its destination as it
+    arrives, so memory use does not depend on the size of the parts.
+    '''
+    max_header_size = 16384
+
+    def __init__(self, rfile, boundary, length, block_size=COPY_CHUNK_SIZE):
+        self.rfile = rfile
+        self.delimiter = '\r\n--' + boundary
+        self.remaining = length
+        self.block_size = block_size
+        # The first delimiter is not preceded by a line break
+        self.buffer = '\r\n'
+
+    def fill(self):
+        '''
+        Read the next block of the body into the buffer
+        :return: False if the body was completely read
+        '''
+        if self.remaining <= 0:
+            return False
+        data = self.rfile.read(min(self.block_size, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buffer += data
+        return True
+
+    def copy_part(self, out):
+        '''
+        Copy the data up to the next delimiter, which is consumed
+        :param out: File object to write the data to, or None to discard it
+        :return: False if the body ended before the delimiter
+        '''
+        keep = len(self.delimiter) - 1
+        while True:
+            idx = self.buffer.find(self.delimiter)
+            if idx >= 0:
+                if out is not None:
+                    out.write(self.buffer[:idx])
+                self.buffer = self.buffer[idx + len(self.delimiter):]
+                return True
+            # Keep the bytes that could be the start of the delimiter
+            if len(self.buffer) > keep:
+                if out is not None:
+                    out.write(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            if not self.fill():
+                return False
+
+    def read_headers(self):
+        '''
+        Read the headers of a part
+        :return: Dictionary of headers, with lower case names
+        '''
+        end = self.buffer.find('\r\n\r\n')
+        while end < 0:
+            if len(self.buffer) > self.max_header_size or not self.fill():
+                raise ValueError("Part headers are invalid")
+            end = self.buffer.find('\r\n\r\n')
+        headers = {}
+        for line in self.buffer[:end].split('\r\n'):
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        self.buffer = self.buffer[end + 4:]
+        return headers
+
+    def read_parts(self, open_part):
+        '''
+        Parse the whole body
+        :param open_part: Function called with the headers of every part,
+                          that returns the file object to write its content
+                          to (it is closed afterwards), or None to skip it
+        :return: -
+        :raise ValueError: if the body is not valid
+        '''
+        # Skip the preamble
+        if not self.copy_part(None):
+            raise ValueError("Content does not contain the boundary")
+        while True:
+            while len(self.buffer) < 2 and self.fill():
+                pass
+            if self.buffer.startswith('--'):
+                # Closing delimiter, discard the epilogue
+                while self.fill():
+                    self.buffer = ''
+                return
+            out = open_part(self.read_headers())
+            try:
+                if not self.copy_part(out):
+                    raise ValueError("Unexpected end of data")
+            finally:
+                if out is not None:
+                    out.close()
+
+
+class HeaderIndex(object):
+    '''
+    In-memory index of the FITS headers of the input files, read once
+    when the files arrive, without reading their data units.  It keeps
+    the primary header of every file and a summary (name, type, shape)
+    of its extensions, and finds the files by the values of their
+    primary header keywords through an inverted index.
+    '''
+    ignored_keywords = frozenset(['', 'COMMENT', 'HISTORY'])
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # File name: metadata, and (keyword, value): file names
+        self.files = {}
+        self.keys = collections.defaultdict(set)
+
+    @staticmethod
+    def normalize(value):
+        '''
+        Normalize a header or query value, so that 12000, 12000.0 and
+        "12000" match each other
+        '''
+        if isinstance(value, bool):
+            return 'T' if value else 'F'
+        if isinstance(value, basestring):
+            value = value.strip()
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return value
+
+    @staticmethod
+    def json_value(value):
+        if value is None or isinstance(value, (basestring, bool, int, long, float)):
+            return value
+        # Complex numbers and undefined values
+        return str(value)
+
+    def read_metadata(self, file_name):
+        '''
+        Read the headers of a file
+        :param file_name: Name of the file, relative to the input folder
+        :return: Metadata of the file
+        :raise IOError: if the file cannot be read
+        '''
+        path = os.path.join(self.path, file_name)
+        st = os.stat(path)
+        hdus = []
+        primary = {}
+        # Iterating over the HDUs only parses the headers, the data units
+        # are skipped
+        with fits.open(path, memmap=True) as hdul:
+            for i, hdu in enumerate(hdul):
+                header = hdu.header
+                naxis = header.get('NAXIS', 0)
+                hdus.append({'name': hdu.name,
+                             'type': type(hdu).__name__,
+                             'shape': [header.get('NAXIS{}'.format(axis), 0)
+                                       for axis in range(naxis, 0, -1)]})
+                if i == 0:
+                    primary = collections.OrderedDict(
+                        (key, self.json_value(value)) for key, value in header.items()
+                        if key not in self.ignored_keywords)
+        return {'file': file_name, 'size': st.st_size, 'mtime': st.st_mtime,
+                'header': primary, 'hdus': hdus}
+
+    def add(self, file_names):
+        '''
+        Index new files.  Files that cannot be read are left out
+        :param file_names: Names of the files, relative to the input folder
+        :return: -
+        '''
+        for file_name in file_names:
+            try:
+                metadata = self.read_metadata(file_name)
+            except Exception as e:
+                logging.warning('Cannot read the headers of {}: {}'.format(file_name, e))
+                continue
+            with self.lock:
+                self.discard(file_name)
+                self.files[file_name] = metadata
+                for key, value in metadata['header'].iteritems():
+                    self.keys[(key, self.normalize(value))].add(file_name)
+
+    def discard(self, file_name):
+        # Called with the lock held
+        metadata = self.files.pop(file_name, None)
+        if metadata is None:
+            return
+        for key, value in metadata['header'].iteritems():
+            names = self.keys.get((key, self.normalize(value)))
+            if names is not None:
+                names.discard(file_name)
+                if not names:
+                    del self.keys[(key, self.normalize(value))]
+
+    def remove(self, file_name):
+        '''
+        Forget a file
+        :param file_name: Name of the file, relative to the input folder
+        :return: -
+        '''
+        with self.lock:
+            self.discard(file_name)
+
+    def __contains__(self, file_name):
+        with self.lock:
+            return file_name in self.files
+
+    def get(self, file_name):
+        '''
+        Get the metadata of a file
+        :param file_name: Name of the file, relative to the input folder
+        :return: Metadata of the file, or None if it is not indexed
+        '''
+        with self.lock:
+            return self.files.get(file_name)
+
+    def search(self, criteria):
+        '''
+        Find the files whose primary header matches all the criteria
+        :param criteria: Dictionary of keyword: list of accepted values
+        :return: Sorted list of file names
+        '''
+        with self.lock:
+            found = None
+            for key, values in criteria.iteritems():
+                names = set()
+                for value in values:
+                    names.update(self.keys.get((key.upper(), self.normalize(value)), ()))
+                found = names if found is None else found & names
+                if not found:
+                    return []
+            return sorted(found if found is not None else self.files)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.files)
+
+
+class TaskQueue(object):
+    '''
+    Thread-safe priority queue of the input files waiting to be processed.
+    Files are handed out by observation id, dither and exposure time
+    (parsed from the EUC_LE1_VIS-... name), and files that are already
+    queued or being processed are not queued again.
+    '''
+    name_pattern = re.compile(r'EUC_LE1_VIS-[^-]+-(\d+)-(\d+)_(\d{8}T\d{6})')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.heap = []
+        self.queued = {}
+        self.dispatched = set()
+        self.removed = 0
+        self.counter = itertools.count()
+
+    @classmethod
+    def priority(cls, file_name):
+        '''
+        Sort key of a file: VIS frames by observation, dither and time,
+        then any other file by name
+        '''
+        match = cls.name_pattern.match(file_name)
+        if match:
+            obs_id, dither, timestamp = match.groups()
+            return (0, int(obs_id), int(dither), timestamp, file_name)
+        return (1, 0, 0, '', file_name)
+
+    def put(self, file_name):
+        '''
+        Queue a file, unless it is already queued or being processed
+        :param file_name: Name of the file
+        :return: Whether the file was queued
+        '''
+        with self.lock:
+            if file_name in self.queued or file_name in self.dispatched:
+                return False
+            # Entries are [key, sequence, file name, valid]
+            entry = [self.priority(file_name), next(self.counter), file_name, True]
+            self.queued[file_name] = entry
+            heapq.heappush(self.heap, entry)
+            self.not_empty.notify()
+            return True
+
+    def get(self, timeout=0):
+        '''
+        Take the first file of the queue and mark it as being processed.
+        If the queue is empty, wait up to timeout seconds for one.
+        :param timeout: Maximum time to wait, in seconds
+        :return: Name of the file, or None if there is none
+        '''
+        file_names = self.get_many(1, timeout)
+        return file_names[0] if file_names else None
+
+    def get_many(self, n, timeout=0):
+        '''
+        Take up to n files from the head of the queue and mark them as
+        being processed.  If the queue is empty, wait up to timeout seconds
+        for the first one.
+        :param n: Maximum number of files
+        :param timeout: Maximum time to wait, in seconds
+        :return: List with the names of the files, empty if there is none
+        '''
+        with self.lock:
+            deadline = time() + timeout
+            while not self.queued:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return []
+                self.not_empty.wait(remaining)
+            file_names = []
+            while self.queued and len(file_names) < n:
+                entry = heapq.heappop(self.heap)
+                if not entry[-1]:
+                    self.removed -= 1
+                    continue
+                file_name = entry[2]
+                del self.queued[file_name]
+                self.dispatched.add(file_name)
+                file_names.append(file_name)
+            return file_names
+
+    def discard(self, file_name):
+        '''
+        Remove a file from the queue, if it is there
+        :param file_name: Name of the file
+        :return: Whether the file was queued
+        '''
+        with self.lock:
+            entry = self.queued.pop(file_name, None)
+            if entry is None:
+                return False
+            # Removed entries stay in the heap until they reach the top, or
+            # until they are the majority and the heap is rebuilt
+            entry[-1] = False
+            self.removed += 1
+            if self.removed > len(self.heap) // 2:
+                self.heap = [e for e in self.heap if e[-1]]
+                heapq.heapify(self.heap)
+                self.removed = 0
+            return True
+
+    def done(self, file_name):
+        '''
+        Forget a file that was processed, so that it could be queued again
+        :param file_name: Name of the file
+        :return: -
+        '''
+        with self.lock:
+            self.dispatched.discard(file_name)
+
+    def requeue(self, file_name):
+        '''
+        Put back in the queue a file whose processing was abandoned
+        :param file_name: Name of the file
+        :return: Whether the file was queued
+        '''
+        self.done(file_name)
+        return self.put(file_name)
+
+    def mark_dispatched(self, file_name):
+        '''
+        Record that a file is being processed, so that it is not queued
+        '''
+        with self.lock:
+            self.dispatched.add(file_name)
+
+    def queued_files(self):
+        with self.lock:
+            return self.queued.keys()
+
+    def peek(self, n):
+        '''
+        Get the next files of the queue, without taking them
+        :param n: Maximum number of files
+        :return: List with the names of the files, in the order in which
+                 they will be handed out
+        '''
+        with self.lock:
+            file_names = []
+            # The heap is explored from its root, a child being a
+            # candidate once its parent was taken
+            candidates = [(self.heap[0], 0)] if self.heap else []
+            while candidates and len(file_names) < n:
+                entry, i = heapq.heappop(candidates)
+                if entry[-1]:
+                    file_names.append(entry[2])
+                for child in (2 * i + 1, 2 * i + 2):
+                    if child < len(self.heap):
+                        heapq.heappush(candidates, (self.heap[child], child))
+            return file_names
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queued)
+
+    def get_stats(self):
+        with self.lock:
+            return {'queued': len(self.queued),
+                    'dispatched': len(self.dispatched)}
+
+
+class CompletionPipeline(threading.Thread):
+    '''
+    Thread that moves the input files of the finished tasks to the
+    processed folder, off the request threads.  The moves requested while
+    a batch is being done are done together as the next batch, with a
+    single sync of the folders for all of them.  Failed moves are retried
+    a few times before the task is marked as failed.
+    '''
+    max_batch = 256
+    max_attempts = 3
+    retry_delay = 0.5
+
+    def __init__(self, tasks, input_dir, processed_dir):
+        threading.Thread.__init__(self, name='completion-pipeline')
+        self.daemon = True
+        self.tasks = tasks
+        self.input_dir = input_dir
+        self.processed_dir = processed_dir
+        self.requests = Queue.Queue()
+
+    def submit(self, task_id, file_name):
+        '''
+        Request the move of the input file of a finished task
+        :param task_id: Identifier of the task
+        :param file_name: Name of the input file of the task
+        :return: -
+        '''
+        self.requests.put((task_id, file_name))
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except Queue.Empty:
+                    break
+            results = [(task_id, file_name, self.move(file_name)) for task_id, file_name in batch]
+            try:
+                sync_directory(self.processed_dir)
+                sync_directory(self.input_dir)
+            except OSError as e:
+                logging.error('Cannot sync {} and {}: {}'.format(self.input_dir, self.processed_dir, e))
+            self.tasks.tasks_completed(results)
+
+    def move(self, file_name):
+        '''
+        Move a file from the input to the processed folder
+        :param file_name: Name of the file
+        :return: None, or the error message if it could not be moved
+        '''
+        src = os.path.join(self.input_dir, file_name)
+        dst = os.path.join(self.processed_dir, file_name)
+        for attempt in range(1, self.max_attempts + 1):
+            # The file may have been moved by a previous attempt
+            if not os.path.exists(src) and os.path.exists(dst):
+                return None
+            try:
+                logging.debug('Trying to move {} to {}'.format(src, dst))
+                move_file(src, dst)
+                return None
+            except (OSError, IOError) as e:
+                error = 'Cannot move {} to {}: {}'.format(src, dst, e)
+                logging.warning('{} (attempt {} of {})'.format(error, attempt, self.max_attempts))
+                if attempt < self.max_attempts:
+                    sleep(self.retry_delay * attempt)
+        logging.error(error)
+        return error
+
+
+class InputPrefetcher(threading.Thread):
+    '''
+    Thread that has the next depth files of the queue of a TaskStore read
+    ahead into the page cache, so that they are read from memory when
+    they are downloaded.  The kernel is asked to read them in the
+    background with posix_fadvise(POSIX_FADV_WILLNEED) where available
+    (Linux), and they are read by this thread otherwise.
+    '''
+    POSIX_FADV_WILLNEED = 3
+
+    def __init__(self, tasks, path, depth):
+        threading.Thread.__init__(self, name='input-prefetcher')
+        self.daemon = True
+        self.tasks = tasks
+        self.path = path
+        self.depth = depth
+        self.wakeup = threading.Event()
+        self.fadvise = self.fadvise_init()
+        # Files of the queue already prefetched
+        self.prefetched = set()
+        self.files = 0
+        self.bytes = 0
+
+    def fadvise_init(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fadvise = libc.posix_fadvise
+        except (OSError, AttributeError):
+            return None
+        fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+        return fadvise
+
+    def notify(self):
+        '''
+        Signal that the head of the queue changed
+        '''
+        self.wakeup.set()
+
+    def run(self):
+        logging.info('Prefetching the next {} input files ({})'.format(
+            self.depth, 'posix_fadvise' if self.fadvise is not None else 'read'))
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            upcoming = self.tasks.queue.peek(self.depth)
+            # Files dispatched or removed are forgotten, so that they are
+            # prefetched again if they are queued again
+            self.prefetched.intersection_update(upcoming)
+            for file_name in upcoming:
+                if file_name not in self.prefetched:
+                    self.prefetch(file_name)
+                    self.prefetched.add(file_name)
+
+    def prefetch(self, file_name):
+        '''
+        Read ahead a file into the page cache
+        :param file_name: Name of the file, relative to the input folder
+        :return: -
+        '''
+        try:
+            fd = os.open(os.path.join(self.path, file_name), os.O_RDONLY)
+        except OSError as e:
+            logging.debug('Cannot prefetch {}: {}'.format(file_name, e))
+            return
+        try:
+            size = os.fstat(fd).st_size
+            if self.fadvise is None or self.fadvise(fd, 0, 0, self.POSIX_FADV_WILLNEED) != 0:
+                while os.read(fd, COPY_CHUNK_SIZE * 16):
+                    pass
+            self.files += 1
+            self.bytes += size
+        finally:
+            os.close(fd)
+
+    def get_stats(self):
+        return {'prefetched': self.files,
+                'prefetched_bytes': self.bytes,
+                'prefetch_depth': self.depth}
+
+
+class TaskIdGenerator(object):
+    '''
+    Generator of unique task identifiers, like
+    QDTsrv_20161016-201129.123456789-0000000042-node, made of the dispatch
+    time with nanoseconds, a sequence number and the node that generated
+    it.  The time never goes backwards, so identifiers sort in dispatch
+    order.
+    '''
+
+    def __init__(self, node_id=None):
+        if node_id is None:
+            node_id = '{}-{}'.format(re.sub(r'[^A-Za-z0-9]', '', socket.gethostname().split('.')[0]),
+                                     os.getpid())
+        self.node_id = node_id
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.last_ns = 0
+
+    def new_ids(self, n):
+        '''
+        Generate identifiers
+        :param n: Number of identifiers
+        :return: List of identifiers
+        '''
+        with self.lock:
+            now_ns = max(int(time() * 1e9), self.last_ns)
+            self.last_ns = now_ns
+            seconds, ns = divmod(now_ns, 1000000000)
+            prefix = strftime("QDTsrv_%Y%m%d-%H%M%S", gmtime(seconds))
+            ids = ['{}.{:09d}-{:010d}-{}'.format(prefix, ns, self.sequence + i, self.node_id)
+                   for i in range(n)]
+            self.sequence += n
+            return ids
+
+
+class TaskJournal(object):
+    '''
+    Append-only journal of the changes of the dispatch state, one JSON
+    record per line, so that it survives a restart of the server.  Every
+    record is written to the file at once, and fsync-ed when sync is
+    called: callers waiting at the same time share a single fsync.
+
+    The journal is replayed at startup, and compacted into a single
+    snapshot record when it grows much longer than the state it holds.
+    '''
+    compact_min_records = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.fd = None
+        self.records = 0
+        self.written = 0
+        self.synced = 0
+
+    @staticmethod
+    def empty_state():
+        # queued: file names; running: {task id: [file, lease expiration]};
+        # completions: {task id: [status, file, finishing time]}
+        return {'queued': set(), 'running': {}, 'completions': {},
+                'obs_id': None, 'current_file': ''}
+
+    @staticmethod
+    def apply(state, record):
+        '''
+        Apply a journal record to a state
+        :param state: State built by the previous records
+        :param record: Journal record
+        :return: -
+        '''
+        event = record['e']
+        if event == 's':
+            state.update(TaskJournal.empty_state())
+            state['queued'].update(record['queued'])
+            state['running'].update(record['running'])
+            state['completions'].update(record['completions'])
+            state['obs_id'] = record['obs_id']
+            state['current_file'] = record['current_file']
+        elif event == 'q':
+            state['queued'].update(record['f'])
+            if 'obs_id' in record:
+                state['obs_id'] = record['obs_id']
+        elif event == 'r':
+            state['queued'].discard(record['f'])
+        elif event == 'd':
+            for task_id, in_file in record['t']:
+                state['queued'].discard(in_file)
+                state['running'][task_id] = [in_file, record['x']]
+                state['current_file'] = in_file
+        elif event == 'h':
+            if record['id'] in state['running']:
+                state['running'][record['id']][1] = record['x']
+        elif event == 'x':
+            in_file = state['running'].pop(record['id'], [None])[0]
+            if in_file is not None and record['requeue']:
+                state['queued'].add(in_file)
+        elif event == 'e':
+            for task_id in record['ids']:
+                if task_id in state['running']:
+                    in_file = state['running'].pop(task_id)[0]
+                    state['completions'][task_id] = ['pending', in_file, None]
+        elif event == 'm':
+            for task_id, status in record['r']:
+                if task_id in state['completions']:
+                    state['completions'][task_id] = [status, None, record['t']]
+
+    def replay(self):
+        '''
+        Read the journal, and open it for appending.  A truncated last
+        record, left by a crash, is dropped.
+        :return: State recorded in the journal
+        '''
+        state = self.empty_state()
+        if os.path.exists(self.path):
+            good_size = 0
+            with open(self.path, 'rb') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        if line.endswith('\n'):
+                            logging.warning('Skipping corrupted record in {}'.format(self.path))
+                            good_size += len(line)
+                            continue
+                        logging.warning('Dropping truncated record at the end of {}'.format(self.path))
+                        break
+                    self.apply(state, record)
+                    self.records += 1
+                    good_size += len(line)
+            if good_size < os.path.getsize(self.path):
+                with open(self.path, 'r+b') as fp:
+                    fp.truncate(good_size)
+        # Files of running or finishing tasks are not waiting any more
+        busy = set(in_file for in_file, _ in state['running'].values())
+        busy.update(in_file for _, in_file, _ in state['completions'].values() if in_file)
+        state['queued'] -= busy
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return state
+
+    def append(self, record):
+        '''
+        Write a record to the journal
+        :param record: Journal record
+        :return: Sequence number of the record, to be passed to sync
+        '''
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            os.write(self.fd, line)
+            self.records += 1
+            self.written += 1
+            return self.written
+
+    def sync(self, seq):
+        '''
+        Wait until a record is on disk
+        :param seq: Sequence number of the record
+        :return: -
+        '''
+        with self.sync_lock:
+            if self.synced >= seq:
+                return
+            with self.lock:
+                target = self.written
+            os.fsync(self.fd)
+            self.synced = target
+
+    def needs_compaction(self, state_size):
+        return self.records > max(self.compact_min_records, 2 * state_size)
+
+    def compact(self, snapshot):
+        '''
+        Replace the journal with a single snapshot record
+        :param snapshot: Snapshot record of the whole state
+        :return: -
+        '''
+        tmp = self.path + '.tmp'
+        with self.sync_lock:
+            with self.lock:
+                with open(tmp, 'wb') as fp:
+                    fp.write(json.dumps(snapshot, separators=(',', ':')) + '\n')
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.rename(tmp, self.path)
+                sync_directory(os.path.dirname(os.path.abspath(self.path)))
+                if self.fd is not None:
+                    os.close(self.fd)
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                logging.debug('Compacted {} journal records'.format(self.records))
+                self.records = 1
+                self.synced = self.written
+
+
+class TaskStore(object):
+    '''
+    Dispatch state of the server: the queue of input files waiting to be
+    processed and the input file of every dispatched task.  One instance
+    is shared by all the request handlers, and by all the worker processes
+    (through a TaskManager) when serving with several workers.
+
+    Dispatched tasks hold a lease of lease_ttl seconds (none if 0), which
+    the client extends with heartbeats.  A reaper thread puts the input
+    file of the tasks whose lease expired back in the queue, and forgets
+    the finished tasks after retention seconds.
+
+    With a journal, every change of this state is recorded in it, and the
+    state is restored from it when the server starts again.
+    '''
+    generate_dummy_files = False
+    input_files_dir = "input"
+    processed_files_dir = "processed"
+    index_batch_size = 64
+
+    def __init__(self, rootdir, lease_ttl=600, journal_path=None, retention=600):
+        self.rootdir = rootdir
+        self.lease_ttl = lease_ttl
+        self.retention = retention
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.reaper = None
+        self.prefetcher = None
+        self.preview_pipeline = None
+        self.completion_pipeline = CompletionPipeline(self,
+                                                      os.path.join(rootdir, self.input_files_dir),
+                                                      os.path.join(rootdir, self.processed_files_dir))
+        self.queue = TaskQueue()
+        self.headers = HeaderIndex(os.path.join(rootdir, self.input_files_dir))
+        self.task_ids = TaskIdGenerator()
+        self.obs_id = 12000
+        self.task_inputs = {}
+        self.current_file = ''
+        # Lease expiration time by task, and a heap of (expiration, task)
+        # where entries superseded by a heartbeat are skipped
+        self.leases = {}
+        self.lease_heap = []
+        # Finishing time of the completed tasks, and state of the tasks
+        # whose input file is being moved or was moved
+        self.finished_tasks = collections.OrderedDict()
+        self.completions = {}
+        self.moving = {}
+        self.expired = 0
+        self.journal = None
+        if journal_path:
+            self.journal = TaskJournal(journal_path)
+            with self.lock:
+                self.restore(self.journal.replay())
+                self.journal.compact(self.snapshot())
+
+    def restore(self, state):
+        '''
+        Restore the state recorded in the journal
+        :param state: State returned by TaskJournal.replay
+        :return: -
+        '''
+        # Called with the lock held
+        now = time()
+        for in_file in sorted(state['queued']):
+            self.queue.put(in_file)
+        for task_id, (in_file, expiration) in sorted(state['running'].items()):
+            self.task_inputs[task_id] = in_file
+            self.queue.mark_dispatched(in_file)
+            if self.lease_ttl > 0:
+                self.leases[task_id] = expiration
+                heapq.heappush(self.lease_heap, (expiration, task_id))
+        for task_id, (status, in_file, finished) in sorted(state['completions'].items(),
+                                                           key=lambda item: item[1][2]):
+            if status == 'pending':
+                # The move of the input file may not have been done
+                self.completions[task_id] = status
+                self.moving[task_id] = in_file
+                self.queue.mark_dispatched(in_file)
+                self.completion_pipeline.submit(task_id, in_file)
+            elif finished > now - self.retention:
+                self.completions[task_id] = status
+                self.finished_tasks[task_id] = finished
+        if state['obs_id'] is not None:
+            self.obs_id = state['obs_id']
+        self.current_file = state['current_file']
+        logging.info('Restored {} queued, {} running and {} finished tasks from {}'.format(
+            len(self.queue), len(self.task_inputs), len(self.completions), self.journal.path))
+
+    def snapshot(self):
+        # Called with the lock held
+        running = dict((task_id, [in_file, self.leases.get(task_id, 0)])
+                       for task_id, in_file in self.task_inputs.iteritems())
+        completions = dict((task_id, [status, self.moving.get(task_id),
+                                      self.finished_tasks.get(task_id)])
+                           for task_id, status in self.completions.iteritems())
+        return {'e': 's', 'queued': self.queue.queued_files(), 'running': running,
+                'completions': completions, 'obs_id': self.obs_id,
+                'current_file': self.current_file}
+
+    def log_event(self, record):
+        '''
+        Record a change of the state in the journal, if any
+        :param record: Journal record
+        :return: Sequence number of the record, for sync_journal
+        '''
+        # Called with the lock held, so that records are in the order of
+        # the changes
+        if self.journal is None:
+            return 0
+        seq = self.journal.append(record)
+        if self.journal.needs_compaction(len(self.queue) + len(self.task_inputs) + len(self.completions)):
+            self.journal.compact(self.snapshot())
+        return seq
+
+    def sync_journal(self, seq):
+        if self.journal is not None and seq:
+            self.journal.sync(seq)
+
+    def create_dummy_file(self, file_name):
+        '''
+        Create dummy FITS file
+        :param file_name: Name of the file to be created
+        :return:
+        '''
+        n = np.arange(100.0)  # a simple sequence of floats from 0.0 to 99.9
+        hdu = fits.PrimaryHDU(n)
+        full_file_name = self.rootdir + "/" + file_name
+        logging.debug('Trying to create dummy file {}'.format(full_file_name))
+        hdu.writeto(full_file_name, clobber=True)
+
+    def get_new_input_files(self):
+        '''
+        Method to get new file names, with path relative to rootdir.
+        This simple test does not get file names from the file system, but
+        generates them, and adds them to the queue
+        :return:
+        '''
+        # Generate dummy files and place them in the input folder
+        new_files = []
+        for x in range(10):
+            for dither in range(1, 5):
+                datetime_tag = strftime("%Y%m%dT%H%M%S", gmtime(time() + 100000000 + x * 100))
+                file_name = 'EUC_LE1_VIS-W-{}-{}_{}.0Z.fits'.format(self.obs_id,
+                                                                    dither, datetime_tag)
+                # create dummy file
+                logging.debug('New file: {}'.format(file_name))
+                self.create_dummy_file(self.input_files_dir + '/' + file_name)
+                self.headers.add([file_name])
+                self.queue.put(file_name)
+                new_files.append(file_name)
+                self.obs_id = self.obs_id + 1
+        self.log_event({'e': 'q', 'f': new_files, 'obs_id': self.obs_id})
+
+        logging.debug('There are {} files in the pool'.format(len(self.queue)))
+
+    def start_watcher(self, poll_interval=2.0, use_inotify=True):
+        '''
+        Start feeding the queue with the files arriving in the input folder
+        :param poll_interval: Seconds between scans when inotify is not used
+        :param use_inotify: Whether to use inotify if available
+        :return: -
+        '''
+        if self.generate_dummy_files or self.watcher is not None:
+            return
+        self.watcher = InputWatcher(self, os.path.join(self.rootdir, self.input_files_dir),
+                                    poll_interval, use_inotify)
+        # The files restored from the journal are already known
+        with self.lock:
+            self.watcher.seen.update(self.queue.queued_files())
+            self.watcher.seen.update(self.task_inputs.values())
+            self.watcher.seen.update(self.moving.values())
+        self.watcher.start()
+
+    def start_completions(self):
+        '''
+        Start moving the input files of the finished tasks
+        :return: -
+        '''
+        processed_dir = os.path.join(self.rootdir, self.processed_files_dir)
+        if not os.path.isdir(processed_dir):
+            os.makedirs(processed_dir)
+        if not self.completion_pipeline.is_alive():
+            self.completion_pipeline.start()
+
+    def start_prefetcher(self, depth):
+        '''
+        Start reading ahead the next input files of the queue
+        :param depth: Number of files read ahead, 0 for none
+        :return: -
+        '''
+        if depth <= 0 or self.prefetcher is not None:
+            return
+        self.prefetcher = InputPrefetcher(self, os.path.join(self.rootdir, self.input_files_dir), depth)
+        self.prefetcher.start()
+        self.prefetch_next()
+
+    def start_previews(self, path, max_bytes, size):
+        '''
+        Start rendering in the background the previews of the input and
+        processed files, in a process of its own
+        :param path: Folder of the preview cache
+        :param max_bytes: Size limit of the preview cache
+        :param size: Maximum width and height of the previews
+        :return: -
+        '''
+        if self.preview_pipeline is not None:
+            return
+        self.preview_pipeline = PreviewPipeline(PreviewCache(path, max_bytes, 1),
+                                                [os.path.join(self.rootdir, self.input_files_dir),
+                                                 os.path.join(self.rootdir, self.processed_files_dir)],
+                                                size, 'png')
+        self.preview_pipeline.start()
+
+    def prefetch_next(self):
+        '''
+        Have the prefetcher read ahead the files now at the head of the
+        queue, if any
+        :return: -
+        '''
+        if self.prefetcher is not None:
+            self.prefetcher.notify()
+
+    def start_reaper(self):
+        '''
+        Start the thread that expires the leases of the tasks and forgets
+        the finished ones
+        :return: -
+        '''
+        if self.reaper is not None:
+            return
+        self.reaper = threading.Thread(target=self.reap_forever, name='task-reaper')
+        self.reaper.daemon = True
+        self.reaper.start()
+
+    def reap_forever(self):
+        period = min(self.lease_ttl, self.retention) if self.lease_ttl > 0 else self.retention
+        interval = min(max(period / 10.0, 0.1), 10.0)
+        while True:
+            sleep(interval)
+            self.reap()
+
+    def reap(self):
+        '''
+        Requeue the input files of the tasks whose lease expired, and
+        forget the tasks finished more than retention seconds ago
+        :return: -
+        '''
+        now = time()
+        expired = []
+        with self.lock:
+            # Without leases the heap stays empty
+            while self.lease_heap and self.lease_heap[0][0] <= now:
+                expiration, task_id = heapq.heappop(self.lease_heap)
+                if self.leases.get(task_id) != expiration:
+                    continue
+                del self.leases[task_id]
+                in_file = self.task_inputs.pop(task_id)
+                expired.append((task_id, in_file))
+                self.expired += 1
+                if os.path.exists(os.path.join(self.rootdir, self.input_files_dir, in_file)):
+                    requeued = self.queue.requeue(in_file)
+                else:
+                    requeued = False
+                    self.queue.done(in_file)
+                self.log_event({'e': 'x', 'id': task_id, 'requeue': requeued})
+            while self.finished_tasks:
+                task_id, finished = next(self.finished_tasks.iteritems())
+                if finished > now - self.retention:
+                    break
+                del self.finished_tasks[task_id]
+                self.completions.pop(task_id, None)
+
+        for task_id, in_file in expired:
+            logging.warning('Lease of task {} expired, requeuing {}'.format(task_id, in_file))
+        if expired:
+            self.prefetch_next()
+
+    def add_input_files(self, file_names):
+        '''
+        Add new input files to the queue, and wake up the waiting dispatches
+        :param file_names: Names of the files, relative to the input folder
+        :return: -
+        '''
+        # Files are indexed before they can be dispatched, a batch at a
+        # time so that a large backlog is dispatched while it is indexed
+        for i in range(0, len(file_names), self.index_batch_size):
+            batch = file_names[i:i + self.index_batch_size]
+            self.headers.add(batch)
+            with self.lock:
+                new_files = [file_name for file_name in batch if self.queue.put(file_name)]
+                if new_files:
+                    self.log_event({'e': 'q', 'f': new_files})
+            for file_name in new_files:
+                logging.debug('Getting file: {}'.format(file_name))
+            if self.preview_pipeline is not None:
+                self.preview_pipeline.submit(new_files)
+        self.prefetch_next()
+
+    def remove_input_file(self, file_name):
+        '''
+        Remove from the queue a file that disappeared from the input folder
+        :param file_name: Name of the file, relative to the input folder
+        :return: -
+        '''
+        self.headers.remove(file_name)
+        with self.lock:
+            removed = self.queue.discard(file_name)
+            if removed:
+                self.log_event({'e': 'r', 'f': file_name})
+        if removed:
+            logging.debug('File {} is gone'.format(file_name))
+
+    def dispatch(self, n=1, timeout=0):
+        '''
+        Create up to n new tasks, assigning them the next files of the
+        queue.  If the queue is empty, wait up to timeout seconds for a
+        new file.
+        :param n: Maximum number of tasks
+        :param timeout: Maximum time to wait for a file, in seconds
+        :return: List of (task id, input file) pairs, which may be shorter
+                 than n (or empty) if there are not enough files
+        '''
+        if self.generate_dummy_files:
+            with self.lock:
+                if len(self.queue) < n:
+                    self.get_new_input_files()
+        in_files = self.queue.get_many(n, timeout)
+        tasks = zip(self.task_ids.new_ids(len(in_files)), in_files)
+        if not tasks:
+            return tasks
+        with self.lock:
+            for task_id, in_file in tasks:
+                self.current_file = in_file
+                self.task_inputs[task_id] = in_file
+                self.renew_lease(task_id)
+            seq = self.log_event({'e': 'd', 't': tasks, 'x': self.leases.get(tasks[0][0], 0)})
+        self.sync_journal(seq)
+        self.prefetch_next()
+        return tasks
+
+    def renew_lease(self, task_id):
+        # Called with the lock held
+        if self.lease_ttl > 0:
+            expiration = time() + self.lease_ttl
+            self.leases[task_id] = expiration
+            heapq.heappush(self.lease_heap, (expiration, task_id))
+
+    def heartbeat(self, task_id):
+        '''
+        Extend the lease of a running task
+        :param task_id: Identifier of the task
+        :return: Seconds until the lease expires (0 if leases are disabled),
+                 or None if the task is not running
+        '''
+        with self.lock:
+            if task_id not in self.task_inputs:
+                return None
+            self.renew_lease(task_id)
+            self.log_event({'e': 'h', 'id': task_id, 'x': self.leases.get(task_id, 0)})
+            return self.lease_ttl
+
+    def get_task_input(self, task_id):
+        '''
+        Get the input file assigned to a running task
+        :param task_id: Identifier of the task
+        :return: Name of the input file of the task
+        :raise KeyError: if the task is unknown, finished or expired
+        '''
+        with self.lock:
+            return self.task_inputs[task_id]
+
+    def complete_tasks(self, task_ids):
+        '''
+        Record that tasks were completed, and request the move of their
+        input files to the processed folder.  Tasks already completed
+        are not moved again.
+        :param task_ids: Identifiers of the tasks
+        :return: Dictionary with the status of every task (see task_status)
+        '''
+        statuses = {}
+        completed = []
+        with self.lock:
+            for task_id in task_ids:
+                if task_id in self.task_inputs:
+                    in_file = self.task_inputs.pop(task_id)
+                    self.leases.pop(task_id, None)
+                    self.completions[task_id] = 'pending'
+                    self.moving[task_id] = in_file
+                    completed.append((task_id, in_file))
+                statuses[task_id] = self.get_status(task_id)
+            seq = self.log_event({'e': 'e', 'ids': [task_id for task_id, _ in completed]}) if completed else 0
+        self.sync_journal(seq)
+        for task_id, in_file in completed:
+            self.completion_pipeline.submit(task_id, in_file)
+        return statuses
+
+    def tasks_completed(self, results):
+        '''
+        Record the result of the moves of the completion pipeline
+        :param results: List of (task id, input file, error) tuples, where
+                        error is None if the file was moved
+        :return: -
+        '''
+        now = time()
+        with self.lock:
+            for task_id, _, error in results:
+                self.completions[task_id] = 'failed' if error else 'done'
+                self.moving.pop(task_id, None)
+                self.finished_tasks[task_id] = now
+            self.log_event({'e': 'm', 't': now,
+                            'r': [(task_id, self.completions[task_id]) for task_id, _, _ in results]})
+        for _, in_file, _ in results:
+            self.queue.done(in_file)
+        if self.preview_pipeline is not None:
+            self.preview_pipeline.submit([in_file for _, in_file, error in results if error is None])
+
+    def get_status(self, task_id):
+        # Called with the lock held
+        if task_id in self.task_inputs:
+            return 'running'
+        return self.completions.get(task_id, 'unknown')
+
+    def task_status(self, task_id):
+        '''
+        Get the status of a task
+        :param task_id: Identifier of the task
+        :return: "running", "pending" (its input file is being moved),
+                 "done", "failed" (the input file could not be moved), or
+                 "unknown" (never dispatched, expired, or forgotten)
+        '''
+        with self.lock:
+            return self.get_status(task_id)
+
+    def index_input_files(self, file_names):
+        '''
+        Index the headers of files already known, e.g. restored from the
+        journal
+        :param file_names: Names of the files, relative to the input folder
+        :return: -
+        '''
+        self.headers.add([file_name for file_name in file_names if file_name not in self.headers])
+
+    def get_file_metadata(self, file_name):
+        '''
+        Get the headers of an input file
+        :param file_name: Name of the file, relative to the input folder
+        :return: Metadata of the file (see HeaderIndex), or None
+        '''
+        return self.headers.get(file_name)
+
+    def search_files(self, criteria):
+        '''
+        Find the input files by the values of their header keywords
+        :param criteria: Dictionary of keyword: list of accepted values
+        :return: Sorted list of file names
+        '''
+        return self.headers.search(criteria)
+
+    def pool_size(self):
+        return len(self.queue)
+
+    def get_stats(self):
+        stats = self.queue.get_stats()
+        with self.lock:
+            stats.update({'indexed': len(self.headers),
+                          'running': len(self.task_inputs),
+                          'finished': len(self.finished_tasks),
+                          'expired': self.expired,
+                          'lease_ttl': self.lease_ttl,
+                          'retention': self.retention})
+        if self.prefetcher is not None:
+            stats.update(self.prefetcher.get_stats())
+        return stats
+
+
+class TaskManager(BaseManager):
+    '''
+    Manager process that serves a single TaskStore to all the worker
+    processes, so that a file is never dispatched twice.
+    '''
+
+TaskManager.register('TaskStore', TaskStore)
+
+
+def make_request_handler_class(opts, tasks):
+    '''
+    Factory to make the request handler and add arguments to it.
+
+    It exists to allow the handler to access the opts.path variable
+    and the task store locally.
+    '''
+
+    class QLARqstHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        '''
+        Factory generated request handler class that contain
+        additional class variables.
+        '''
+        m_opts = opts
+        m_cache = (ContentCache(opts.cache_size * 1024 * 1024, opts.cache_max_file * 1024 * 1024)
+                   if opts.cache_size > 0 else None)
+        m_latency = (LatencyInjector(opts.delay, opts.bandwidth, opts.latency_seed)
+                     if opts.delay or opts.bandwidth else None)
+        m_stats = QuickLookStats(opts.stats_workers)
+        m_previews = (PreviewCache(opts.preview_dir, opts.preview_cache * 1024 * 1024, opts.preview_workers)
+                      if opts.preview_cache > 0 else None)
+        content_type = {
+            '.css': 'text/css',
+            '.gif': 'image/gif',
+            '.htm': 'text/html',
+            '.html': 'text/html',
+            '.jpeg': 'image/jpeg',
+            '.jpg': 'image/jpg',
+            '.js': 'text/javascript',
+            '.png': 'image/png',
+            '.text': 'text/plain',
+            '.txt': 'text/plain',
+            '.fits': 'application/fits',
+            '.json': 'application/json'
+        }
+
+        if not mimetypes.inited:
+            mimetypes.init()  # try to read system mime.types
+        extensions_map = mimetypes.types_map.copy()
+        extensions_map.update({
+            '': 'application/octet-stream',  # Default
+            '.py': 'text/plain',
+            '.c': 'text/plain',
+            '.h': 'text/plain',
+        })
+
+        # Content codings, by order of preference, the suffix of their
+        # precompressed files, and the types worth compressing on the fly
+        content_encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+        precompressed_suffixes = collections.OrderedDict([('br', '.br'), ('gzip', '.gz')])
+        compressible_types = ('text/', 'application/json', 'application/javascript',
+                              'application/xml', 'image/svg+xml')
+
+        m_tasks = tasks
+        # Whether requests may block waiting for new input files
+        long_poll = True
+        generate_dummy_files = TaskStore.generate_dummy_files
+        input_files_dir = TaskStore.input_files_dir
+        processed_files_dir = TaskStore.processed_files_dir
+
+        # Persistent connections: every response has a Content-Length, or
+        # is sent with chunked transfer encoding
+        protocol_version = 'HTTP/1.1'
+        # Buffer the status line, headers and small bodies to send them
+        # in one segment
+        wbufsize = -1
+        # Idle keep-alive connections are closed after this time
+        timeout = opts.idle_timeout
+        chunked = False
+        # Requests read on the connection
+        requests_handled = 0
+        # Whether the response is sent after the handler returns
+        deferred = False
+
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def end_headers(self):
+            # A busy pool gives the worker of this connection to the
+            # connections waiting for one after the response
+            busy = getattr(self.server, 'busy', None)
+            if busy is not None and not self.close_connection and busy():
+                self.send_header('Connection', 'close')
+            BaseHTTPServer.BaseHTTPRequestHandler.end_headers(self)
+
+        def input_pending(self):
+            '''
+            Check whether the client already sent more (pipelined) requests
+            that are waiting in the read buffer
+            '''
+            rbuf = getattr(self.rfile, '_rbuf', None)
+            if rbuf is None:
+                return False
+            rbuf.seek(0, 2)
+            return rbuf.tell() > 0
+
+        def handle_one_request(self):
+            '''
+            Handle a single HTTP request.  Unlike the base class, the response
+            is not flushed while further pipelined requests are already
+            buffered, so that the responses to a pipeline are sent together.
+            '''
+            try:
+                wait_for_request = getattr(self.server, 'wait_for_request', None)
+                if self.requests_handled and wait_for_request is not None and not self.input_pending():
+                    if not wait_for_request(self.connection, self.timeout):
+                        self.close_connection = 1
+                        return
+                self.requests_handled += 1
+                self.raw_requestline = self.rfile.readline(65537)
+                if len(self.raw_requestline) > 65536:
+                    self.requestline = ''
+                    self.request_version = ''
+                    self.command = ''
+                    self.send_error(414)
+                    return
+                if not self.raw_requestline:
+                    self.close_connection = 1
+                    return
+                if not self.parse_request():
+                    # An error code has been sent, just exit
+                    return
+                delay = self.injected_delay()
+                if delay > 0:
+                    self.wfile.flush()
+                    sleep(delay)
+                mname = 'do_' + self.command
+                if not hasattr(self, mname):
+                    self.send_error(501, "Unsupported method (%r)" % self.command)
+                    return
+                method = getattr(self, mname)
+                method()
+                if not self.input_pending():
+                    self.wfile.flush()
+            except socket.timeout as e:
+                # a read or a write timed out.  Discard this connection
+                self.log_error("Request timed out: %r", e)
+                self.close_connection = 1
+
+        def injected_delay(self):
+            '''
+            Get the artificial delay of the request, if latency is injected
+            :return: Seconds to wait before handling the request
+            '''
+            if QLARqstHandler.m_latency is None:
+                return 0
+            return QLARqstHandler.m_latency.delay(self.path)
+
+        def injected_rate(self):
+            '''
+            Get the artificial bandwidth limit of the request
+            :return: Bytes per second, or None if not limited
+            '''
+            if QLARqstHandler.m_latency is None:
+                return None
+            return QLARqstHandler.m_latency.rate(self.path)
+
+        def send_content(self, code=200, mimetype='text/html', more=False):
+            '''
+            Send response code (default 200), and content type (default text/html)
+            :param code: response code (default:200)
+            :param mimetype: content type (default:text/html)
+            :return: -
+            '''
+            self.send_response(code)
+            if len(mimetype) > 0:
+                self.send_header('Content-type', mimetype)
+                if not more:
+                    self.end_headers()
+
+        def send_body(self, body, code=200, mimetype='text/html', headers=()):
+            '''
+            Send a complete response with its body
+            :param body: Content of the response
+            :param code: response code (default:200)
+            :param mimetype: content type (default:text/html)
+            :param headers: additional (name, value) headers
+            :return: -
+            '''
+            self.send_content(code=code, mimetype=mimetype, more=True)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_chunked_content(self, code=200, mimetype='text/html', headers=()):
+            '''
+            Start a response whose body is not known in advance.  It is sent
+            with write_chunk as it is produced, and finished with end_chunks.
+            HTTP/1.0 clients get the body as is, and the connection is
+            closed after it.
+            :param code: response code (default:200)
+            :param mimetype: content type (default:text/html)
+            :param headers: additional (name, value) headers
+            :return: -
+            '''
+            self.send_content(code=code, mimetype=mimetype, more=True)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.chunked = self.request_version >= 'HTTP/1.1'
+            if self.chunked:
+                self.send_header('Transfer-Encoding', 'chunked')
+            else:
+                self.close_connection = 1
+            self.end_headers()
+
+        def write_chunk(self, data):
+            if not data:
+                return
+            if self.chunked:
+                self.wfile.write('{:x}\r\n'.format(len(data)))
+                self.wfile.write(data)
+                self.wfile.write('\r\n')
+            else:
+                self.wfile.write(data)
+
+        def end_chunks(self):
+            if self.chunked:
+                self.wfile.write('0\r\n\r\n')
+
+        def do_HEAD(self):
+            '''
+            Handle a HEAD request.
+            '''
+            logging.debug('HEADER %s' % (self.path))
+            self.send_content()
+
+        def do_info(self):
+            '''
+            Display some useful server information.
+
+            http://127.0.0.1:8080/info
+            '''
+            self.send_chunked_content()
+
+            self.write_chunk('<html><head><title>Server Info</title></head>')
+            self.write_chunk('<body><table><tbody>')
+            self.write_chunk('<tr><td>client_address</td><td>%r</td></tr>' % (repr(self.client_address)))
+            self.write_chunk('<tr><td>command</td><td>%r</td></tr>' % (repr(self.command)))
+            self.write_chunk('<tr><td>headers</td><td>%r</td></tr>' % (repr(self.headers)))
+            self.write_chunk('<tr><td>path</td><td>%r</td></tr>' % (repr(self.path)))
+            self.write_chunk('<tr><td>server_version</td><td>%r</td></tr>' % (repr(self.server_version)))
+            self.write_chunk('<tr><td>sys_version</td><td>%r</td></tr>' % (repr(self.sys_version)))
+            self.write_chunk('</tbody></table></body></html>')
+            self.end_chunks()
+
+        def do_status(self):
+            '''
+            Report serving statistics as JSON
+
+            http://127.0.0.1:8080/status
+            :return: -
+            '''
+            status = {'engine': QLARqstHandler.m_opts.engine,
+                      'threads': threading.active_count()}
+            if hasattr(self.server, 'get_stats'):
+                status['server'] = self.server.get_stats()
+            if QLARqstHandler.m_cache is not None:
+                status['cache'] = QLARqstHandler.m_cache.get_stats()
+            status['stats'] = QLARqstHandler.m_stats.get_stats()
+            if QLARqstHandler.m_previews is not None:
+                status['previews'] = QLARqstHandler.m_previews.get_stats()
+            status['tasks'] = QLARqstHandler.m_tasks.get_stats()
+            self.send_body(json.dumps(status), mimetype='application/json')
+
+        def task_params(self, task_id, in_file):
+            '''
+            Build the dictionary with the information of a task
+            :param task_id: Identifier of the task
+            :param in_file: Input file of the task
+            :return: Dictionary with the task parameters
+            '''
+            out_file = re.sub('.fits', '.json', re.sub('LE1_VIS', 'QLA_LE1-VIS', in_file))
+            log_file = re.sub('.json', '.log', re.sub('LE1-VIS', 'LE1-VIS-LOG', out_file))
+            return {'task_id': task_id,
+                    'in_file': in_file,
+                    'out_file': out_file,
+                    'log_file': log_file,
+                    'retrieve_path': QLARqstHandler.input_files_dir,
+                    'lease_ttl': QLARqstHandler.m_opts.lease_ttl}
+
+        def dispatch_tasks(self, n, wait):
+            '''
+            Assign input files to up to n new tasks, waiting for new files
+            up to the requested time (but no more than --task-wait)
+            :param n: Maximum number of tasks
+            :param wait: Seconds to wait for new input files, or None
+            :return: List of task parameter dictionaries
+            '''
+            max_wait = QLARqstHandler.m_opts.task_wait if self.long_poll else 0
+            wait = max_wait if wait is None else max(min(wait, max_wait), 0)
+            if wait > 0:
+                # Do not hold the responses to previous pipelined requests
+                self.wfile.flush()
+            tasks = QLARqstHandler.m_tasks.dispatch(n, wait)
+            task_list = [self.task_params(task_id, in_file) for task_id, in_file in tasks]
+            for task_params in task_list:
+                logging.debug(json.dumps(task_params))
+            logging.debug('There are {} files left in the pool'.format(QLARqstHandler.m_tasks.pool_size()))
+            return task_list
+
+        def do_get_task(self, wait=None):
+            '''
+            Provide input data to the client to run a new task.  If there
+            is no input file, wait for one up to the requested time (but no
+            more than --task-wait), and answer 204 No Content otherwise.
+
+            http://127.0.0.1:8080/get_task?wait=10
+            :param wait: Seconds to wait for new input files
+            :return: -
+            '''
+            task_list = self.dispatch_tasks(1, wait)
+            if not task_list:
+                logging.debug('No input files available')
+                self.send_response(204)
+                self.end_headers()
+                return
+
+            # Send it
+            self.send_body(json.dumps(task_list[0]), mimetype='application/json')
+
+        def do_get_tasks(self, n, wait=None):
+            '''
+            Provide input data to the client to run up to n new tasks, as a
+            JSON list of task parameters.  Waits for input files like
+            do_get_task, and answers 204 No Content if there are none.
+
+            http://127.0.0.1:8080/get_tasks?n=10
+            :param n: Maximum number of tasks
+            :param wait: Seconds to wait for new input files
+            :return: -
+            '''
+            n = max(min(n, QLARqstHandler.m_opts.max_batch), 1)
+            task_list = self.dispatch_tasks(n, wait)
+            if not task_list:
+                logging.debug('No input files available')
+                self.send_response(204)
+                self.end_headers()
+                return
+
+            self.send_body(json.dumps(task_list), mimetype='application/json')
+
+        def do_heartbeat(self, task_id):
+            '''
+            Extend the lease of a running task
+
+            http://127.0.0.1:8080/heartbeat?task_id=...
+            :param task_id: Identifier of the task
+            :return: -
+            '''
+            lease_ttl = QLARqstHandler.m_tasks.heartbeat(task_id)
+            if lease_ttl is None:
+                self.send_unknown_task(task_id)
+                return
+            self.send_body(json.dumps({'task_id': task_id, 'lease_ttl': lease_ttl}),
+                           mimetype='application/json')
+
+        def send_unknown_task(self, task_id):
+            '''
+            Answer a request about a task that is not running (never
+            dispatched, already finished, or whose lease expired)
+            :param task_id: Identifier of the task
+            :return: -
+            '''
+            logging.warning('Task {} is not running'.format(task_id))
+            self.send_body(json.dumps({'task_id': task_id, 'error': 'Task is not running'}),
+                           code=404, mimetype='application/json')
+
+        def do_meta(self, file_name):
+            '''
+            Send the headers of an input file, from the index
+
+            http://127.0.0.1:8080/meta?file=EUC_LE1_VIS-...fits
+            :param file_name: Name of the file, relative to the input folder
+            '''
+            metadata = QLARqstHandler.m_tasks.get_file_metadata(file_name)
+            if metadata is None:
+                self.send_body(json.dumps({'file': file_name, 'error': 'File not indexed'}),
+                               code=404, mimetype='application/json')
+                return
+            self.send_body(json.dumps(metadata), mimetype='application/json')
+
+        def do_search(self, criteria):
+            '''
+            Find the input files whose primary header has the values given
+            for each keyword (any of them, if a keyword is repeated)
+
+            http://127.0.0.1:8080/search?OBS_ID=12000&DITHOBS=3
+            :param criteria: Dictionary of keyword: list of values
+            '''
+            files = QLARqstHandler.m_tasks.search_files(criteria)
+            self.send_body(json.dumps({'count': len(files), 'files': files}),
+                           mimetype='application/json')
+
+        def do_cutout(self, args):
+            '''
+            Send an HDU of an input file, or a region of an image HDU, as a
+            FITS file or as raw (big-endian) data.  The file is memory
+            mapped, only the bytes requested are read.
+
+            http://127.0.0.1:8080/cutout?file=...&hdu=CCD_1&rows=0:100&cols=50:150&format=fits
+            :param args: Arguments of the request: file (relative to the
+                         input folder), hdu (index or name, default 0),
+                         rows and cols (START:STOP, default all),
+                         format (fits or raw, default fits)
+            '''
+            file_name = args['file'][0]
+            fmt = args.get('format', ['fits'])[0]
+            if os.path.basename(file_name) != file_name or fmt not in ('fits', 'raw'):
+                self.send_bad_request('Invalid file name or format')
+                return
+            path = os.path.join(QLARqstHandler.m_opts.rootdir, QLARqstHandler.input_files_dir, file_name)
+            if not os.path.isfile(path):
+                self.send_body(json.dumps({'file': file_name, 'error': 'File not found'}),
+                               code=404, mimetype='application/json')
+                return
+
+            # Pixel values are left as stored (BZERO/BSCALE stay in the
+            # header), so that they are not converted
+            hdu_key = args.get('hdu', ['0'])[0]
+            try:
+                hdul = fits.open(path, memmap=True, do_not_scale_image_data=True)
+            except (IOError, OSError, ValueError) as e:
+                self.send_bad_request('Cannot read {}: {}'.format(file_name, e))
+                return
+            with hdul:
+                try:
+                    index = int(hdu_key) if hdu_key.isdigit() else hdul.index_of(hdu_key)
+                    hdu = hdul[index]
+                except (KeyError, IndexError):
+                    self.send_body(json.dumps({'file': file_name, 'error': 'No HDU ' + hdu_key}),
+                                   code=404, mimetype='application/json')
+                    return
+                except (IOError, OSError, ValueError) as e:
+                    self.send_bad_request('Cannot read {}: {}'.format(file_name, e))
+                    return
+                if 'rows' not in args and 'cols' not in args:
+                    self.send_hdu(path, hdul, index, fmt)
+                    return
+                if not isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) or hdu.header.get('NAXIS') != 2:
+                    self.send_bad_request('Cutouts need a 2-D image HDU')
+                    return
+                data = hdu.data
+                try:
+                    rows = parse_slice(args.get('rows', [':'])[0], data.shape[0])
+                    cols = parse_slice(args.get('cols', [':'])[0], data.shape[1])
+                except ValueError as e:
+                    self.send_bad_request(str(e))
+                    return
+                self.send_cutout(hdu.header, data[rows[0]:rows[1], cols[0]:cols[1]], rows, cols, fmt)
+
+        def do_stats(self, args):
+            '''
+            Send quick-look statistics of the image HDUs of an input file:
+            min, max, mean, median, standard deviation, sigma-clipped
+            mean, median and deviation, and histogram
+
+            http://127.0.0.1:8080/stats?file=...&hdu=CCD_1&bins=64&sigma=3
+            :param args: Arguments of the request: file (relative to the
+                         input folder), hdu (index or name, default all),
+                         bins (default 64), sigma (clipping, default 3)
+            '''
+            file_name = args['file'][0]
+            hdu_key = args['hdu'][0] if 'hdu' in args else None
+            try:
+                bins = int(args.get('bins', ['64'])[0])
+                sigma = float(args.get('sigma', ['3'])[0])
+            except ValueError:
+                bins = sigma = 0
+            if os.path.basename(file_name) != file_name or not 0 < bins <= 4096 or not sigma > 0:
+                self.send_bad_request('Invalid file name, bins or sigma')
+                return
+            path = os.path.join(QLARqstHandler.m_opts.rootdir, QLARqstHandler.input_files_dir, file_name)
+            if not os.path.isfile(path):
+                self.send_body(json.dumps({'file': file_name, 'error': 'File not found'}),
+                               code=404, mimetype='application/json')
+                return
+            try:
+                self.wait_result(lambda callback: QLARqstHandler.m_stats.get_async(path, hdu_key, bins,
+                                                                                   sigma, callback),
+                                 lambda hdus, error: self.send_stats(file_name, hdu_key, hdus, error))
+            except OSError:
+                # Removed meanwhile
+                self.send_body(json.dumps({'file': file_name, 'error': 'File not found'}),
+                               code=404, mimetype='application/json')
+
+        def send_stats(self, file_name, hdu_key, hdus, error):
+            '''
+            Send the statistics of a file, or the error computing them
+            :param file_name: Name of the file, relative to the input folder
+            :param hdu_key: Index or name of the HDU asked for, or None
+            :param hdus: Statistics by HDU, None if there was an error
+            :param error: Exception raised by the computation, or None
+            :return: -
+            '''
+            if isinstance(error, KeyError):
+                self.send_body(json.dumps({'file': file_name, 'error': 'No HDU ' + hdu_key}),
+                               code=404, mimetype='application/json')
+            elif error is not None:
+                self.send_bad_request('Cannot read {}: {}'.format(file_name, error))
+            else:
+                self.send_body(json.dumps({'file': file_name, 'hdus': hdus}), mimetype='application/json')
 
+        def wait_result(self, start, respond):
+            '''
+            Wait for a result computed in the background, and send the
+            response with it
+            :param start: Function starting the computation, called with
+                          the function to call with the result and error
+            :param respond: Function sending the response, called with the
+                            result and error
+            :return: -
+            '''
+            done = threading.Event()
+            outcome = []
 
-class ThreadedHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
-    """ This class allows to handle requests in separated threads.
-        No further content needed, don't touch this. """
+            def callback(result, error):
+                outcome.append((result, error))
+                done.set()
 
+            start(callback)
+            done.wait()
+            respond(*outcome[0])
 
-def make_request_handler_class(opts):
-    '''
-    Factory to make the request handler and add arguments to it.
+        def do_preview(self, args):
+            '''
+            Send a preview of an image HDU of an input or processed file,
+            reduced and stretched with zscale, from the preview cache
 
-    It exists to allow the handler to access the opts.path variable
-    locally.
-    '''
+            http://127.0.0.1:8080/preview?file=...&hdu=CCD_1&size=512&format=png
+            :param args: Arguments of the request: file (name of the file
+                         in the input or processed folder), hdu (index or
+                         name, default the first 2-D image), size (maximum
+                         width and height, default --preview-size), format
+                         (png or jpeg, default png)
+            '''
+            file_name = args['file'][0]
+            hdu_key = args['hdu'][0] if 'hdu' in args else None
+            fmt = args.get('format', ['png'])[0]
+            try:
+                size = int(args.get('size', [QLARqstHandler.m_opts.preview_size])[0])
+            except ValueError:
+                size = 0
+            if os.path.basename(file_name) != file_name or not 16 <= size <= 4096:
+                self.send_bad_request('Invalid file name or size')
+                return
+            if fmt not in PreviewCache.formats:
+                self.send_bad_request('Format not available: ' + fmt)
+                return
+            for folder in (QLARqstHandler.input_files_dir, QLARqstHandler.processed_files_dir):
+                path = os.path.join(QLARqstHandler.m_opts.rootdir, folder, file_name)
+                if os.path.isfile(path):
+                    break
+            else:
+                self.send_body(json.dumps({'file': file_name, 'error': 'File not found'}),
+                               code=404, mimetype='application/json')
+                return
+            try:
+                self.wait_result(lambda callback: QLARqstHandler.m_previews.get_async(path, hdu_key, size,
+                                                                                      fmt, callback),
+                                 lambda preview_path, error: self.send_preview(path, hdu_key, size, fmt,
+                                                                               preview_path, error))
+            except OSError:
+                # Moved or removed meanwhile
+                self.send_body(json.dumps({'file': file_name, 'error': 'File not found'}),
+                               code=404, mimetype='application/json')
 
-    class QLARqstHandler(BaseHTTPServer.BaseHTTPRequestHandler):
-        '''
-        Factory generated request handler class that contain
-        additional class variables.
-        '''
-        m_opts = opts
-        content_type = {
-            '.css': 'text/css',
-            '.gif': 'image/gif',
-            '.htm': 'text/html',
-            '.html': 'text/html',
-            '.jpeg': 'image/jpeg',
-            '.jpg': 'image/jpg',
-            '.js': 'text/javascript',
-            '.png': 'image/png',
-            '.text': 'text/plain',
-            '.txt': 'text/plain',
-            '.fits': 'application/fits',
-            '.json': 'application/json'
-        }
+        def send_preview(self, path, hdu_key, size, fmt, preview_path, error):
+            '''
+            Send a preview, or the error rendering it
+            :param path: Full path of the FITS file
+            :param hdu_key: Index or name of the HDU asked for, or None
+            :param size: Maximum width and height of the preview
+            :param fmt: png or jpeg
+            :param preview_path: Path of the preview, None if there was an
+                                 error
+            :param error: Exception raised rendering it, or None
+            :return: -
+            '''
+            file_name = os.path.basename(path)
+            if isinstance(error, KeyError):
+                self.send_body(json.dumps({'file': file_name, 'error': 'No HDU ' + hdu_key}),
+                               code=404, mimetype='application/json')
+                return
+            elif error is not None:
+                self.send_bad_request('Cannot preview {}: {}'.format(file_name, error))
+                return
+            try:
+                self.send_static(preview_path, PreviewCache.formats[fmt][1])
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Evicted by another process before it was opened: it is
+                # rendered again, which is rare enough to be waited for
+                try:
+                    preview_path = QLARqstHandler.m_previews.get(path, hdu_key, size, fmt)
+                except (KeyError, IOError, OSError, ValueError) as e:
+                    self.send_bad_request('Cannot preview {}: {}'.format(file_name, e))
+                    return
+                self.send_static(preview_path, PreviewCache.formats[fmt][1])
 
-        if not mimetypes.inited:
-            mimetypes.init()  # try to read system mime.types
-        extensions_map = mimetypes.types_map.copy()
-        extensions_map.update({
-            '': 'application/octet-stream',  # Default
-            '.py': 'text/plain',
-            '.c': 'text/plain',
-            '.h': 'text/plain',
-        })
+        def send_hdu(self, path, hdul, index, fmt):
+            '''
+            Send a whole HDU, copied as is from the file
+            :param path: Full path of the file
+            :param hdul: HDUList of the file, open
+            :param index: Index of the HDU
+            :param fmt: fits, for a FITS file with the HDU (after an empty
+                        primary HDU if it is an extension), or raw for its
+                        data unit only
+            :return: -
+            '''
+            header = hdul[index].header
+            info = hdul.fileinfo(index)
+            if fmt == 'raw':
+                naxes = [header.get('NAXIS{}'.format(axis), 0) for axis in range(1, header.get('NAXIS', 0) + 1)]
+                size = (abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) *
+                        (header.get('PCOUNT', 0) + (reduce(lambda a, b: a * b, naxes, 1) if naxes else 0)))
+                prefix = ''
+                offset = info['datLoc']
+                headers = [('X-FITS-BITPIX', str(header['BITPIX'])),
+                           ('X-FITS-Shape', ','.join(str(n) for n in reversed(naxes)))]
+            else:
+                prefix = fits.PrimaryHDU().header.tostring() if index > 0 else ''
+                offset = info['hdrLoc']
+                size = info['datLoc'] + info['datSpan'] - offset
+                headers = []
+            self.send_content(mimetype='application/fits' if fmt == 'fits' else 'application/octet-stream',
+                              more=True)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(prefix) + size))
+            self.end_headers()
+            self.wfile.write(prefix)
+            with open(path, 'rb') as ifp:
+                self.stream_file(ifp, offset, size)
 
-        generate_dummy_files = False
-        pool_of_files = []
-        obs_id = 12000
-        input_files_dir = "input"
-        processed_files_dir = "processed"
-        task_inputs = {}
-        current_file = ''
+        def send_cutout(self, header, data, rows, cols, fmt):
+            '''
+            Send a region of an image
+            :param header: Header of the image HDU
+            :param data: Memory mapped region of the image
+            :param rows: (start, stop) rows of the region
+            :param cols: (start, stop) columns of the region
+            :param fmt: fits, for a FITS file with the region as primary
+                        HDU, or raw for the pixels only
+            :return: -
+            '''
+            if fmt == 'fits':
+                structural = ('SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND',
+                              'PCOUNT', 'GCOUNT', 'CHECKSUM', 'DATASUM', 'END')
+                cutout_header = fits.Header([('SIMPLE', True), ('BITPIX', header['BITPIX']), ('NAXIS', 2),
+                                             ('NAXIS1', data.shape[1]), ('NAXIS2', data.shape[0])])
+                for card in header.cards:
+                    if card.keyword not in structural:
+                        cutout_header.append(card, bottom=True)
+                # Keep the world coordinates of the pixels
+                if 'CRPIX1' in cutout_header:
+                    cutout_header['CRPIX1'] -= cols[0]
+                if 'CRPIX2' in cutout_header:
+                    cutout_header['CRPIX2'] -= rows[0]
+                cutout_header['CUTROWS'] = ('{}:{}'.format(*rows), 'rows of the original image')
+                cutout_header['CUTCOLS'] = ('{}:{}'.format(*cols), 'columns of the original image')
+                prefix = cutout_header.tostring()
+                padding = -data.nbytes % 2880
+                self.send_content(mimetype='application/fits', more=True)
+            else:
+                prefix = ''
+                padding = 0
+                self.send_content(mimetype='application/octet-stream', more=True)
+                self.send_header('X-FITS-BITPIX', str(header['BITPIX']))
+                self.send_header('X-FITS-Shape', '{},{}'.format(*data.shape))
+            self.send_header('Content-Length', str(len(prefix) + data.nbytes + padding))
+            self.end_headers()
+            self.wfile.write(prefix)
+            # The rows are read from the file a block at a time
+            self.stream_array(data, max(COPY_CHUNK_SIZE // max(data.strides[0], 1), 1))
+            self.wfile.write('\0' * padding)
 
-        def send_content(self, code=200, mimetype='text/html', more=False):
+        def send_bad_request(self, message):
             '''
-            Send response code (default 200), and content type (default text/html)
-            :param code: response code (default:200)
-            :param mimetype: content type (default:text/html)
+            Answer a request with missing or invalid arguments
+            :param message: Description of the problem
             :return: -
             '''
-            self.send_response(200)  # OK
-            if len(mimetype) > 0:
-                self.send_header('Content-type', mimetype)
-                if not more:
-                    self.end_headers()
+            logging.warning('Bad request {}: {}'.format(self.path, message))
+            self.send_body(json.dumps({'error': message}), code=400, mimetype='application/json')
 
-        def create_dummy_file(self, file_name):
-            '''
-            Create dummy FITS file
-            :param file_name: Name of the file to be created
-            :return:
-            '''
-            n = np.arange(100.0)  # a simple sequence of floats from 0.0 to 99.9
-            hdu = fits.PrimaryHDU(n)
-            full_file_name = QLARqstHandler.m_opts.rootdir + "/" + file_name
-            logging.debug('Trying to create dummy file {}'.format(full_file_name))
-            hdu.writeto(full_file_name, clobber=True)
-
-        def get_new_input_files(self, pool):
-            '''
-            Method to get new file names, with path relative to rootdir.
-            This simple test does not get file names from the file system, but
-            generates them:
-            :param pool: List to append the new files to
-            :return:
-            '''
-            if QLARqstHandler.generate_dummy_files:
-                # Generate dummy files and place them in the input folder
-                for x in range(10):
-                    for dither in range(1, 5):
-                        datetime_tag = strftime("%Y%m%dT%H%M%S", gmtime(time() + 100000000 + x * 100))
-                        file_name = 'EUC_LE1_VIS-W-{}-{}_{}.0Z.fits'.format(QLARqstHandler.obs_id,
-                                                                            dither, datetime_tag)
-                        pool.append(file_name)
-                        # create dummy file
-                        logging.debug('New file: {}'.format(file_name))
-                        self.create_dummy_file(QLARqstHandler.input_files_dir + '/' + file_name)
-                        QLARqstHandler.obs_id = QLARqstHandler.obs_id + 1
+        def do_end_task(self, task_ids):
+            '''
+            Mark one or several tasks as completed.  Their input files are
+            moved to the processed folder in the background, and the answer
+            is 202 Accepted with the URL where the status of the tasks can
+            be checked.  Ending a task again is harmless.
+
+            http://127.0.0.1:8080/end_task?task_id=...&task_id=...
+            :param task_ids: Identifiers of the tasks
+            '''
+            statuses = QLARqstHandler.m_tasks.complete_tasks(task_ids)
+            status_url = '/task_status?' + urllib.urlencode([('task_id', task_id) for task_id in task_ids])
+            if len(task_ids) == 1:
+                status = statuses[task_ids[0]]
+                if status == 'unknown':
+                    self.send_unknown_task(task_ids[0])
+                    return
+                result = {'task_id': task_ids[0], 'status': status, 'status_url': status_url}
             else:
-                # Generate list from .fits files located in input folder
-                logging.debug('Getting new files . . .')
-                while len(pool) < 1:
-                    for entry in glob.glob('{}/{}/*.fits'.format(QLARqstHandler.m_opts.rootdir,
-                                                                 QLARqstHandler.input_files_dir)):
-                        file_name = os.path.basename(entry)
-                        logging.debug('Getting file: {}'.format(file_name))
-                        pool.append(file_name)
+                for task_id in task_ids:
+                    if statuses[task_id] == 'unknown':
+                        logging.warning('Task {} is not running'.format(task_id))
+                result = {'tasks': statuses, 'status_url': status_url}
+            self.send_body(json.dumps(result), code=202, mimetype='application/json',
+                           headers=[('Location', status_url)])
 
-            logging.debug('There are {} files in the pool'.format(len(QLARqstHandler.pool_of_files)))
+        def do_task_status(self, task_ids):
+            '''
+            Report the status of one or several tasks: running, pending (its
+            input file is being moved), done, failed or unknown
 
-        def do_HEAD(self):
+            http://127.0.0.1:8080/task_status?task_id=...&task_id=...
+            :param task_ids: Identifiers of the tasks
             '''
-            Handle a HEAD request.
+            statuses = dict((task_id, QLARqstHandler.m_tasks.task_status(task_id))
+                            for task_id in task_ids)
+            if len(task_ids) == 1:
+                status = statuses[task_ids[0]]
+                self.send_body(json.dumps({'task_id': task_ids[0], 'status': status}),
+                               code=404 if status == 'unknown' else 200,
+                               mimetype='application/json')
+            else:
+                self.send_body(json.dumps({'tasks': statuses}), mimetype='application/json')
+
+        def send_file(self, path):
             '''
-            logging.debug('HEADER %s' % (self.path))
-            self.send_content()
+            Sends an existing, requested file
+            :param path: Full path of the requested file
+            :return: -
+            '''
+            _, ext = os.path.splitext(path)
+            ext = ext.lower()
 
-        def do_info(self):
+            # If it is a known extension, set the correct
+            # content type in the response.
+            # Unknown file types are sent with the default type.
+            mimetype = QLARqstHandler.content_type.get(ext, 'text/html')
+            # Unknown types are sent as text/html, but not compressed
+            compressible = (QLARqstHandler.content_type.get(ext) or
+                            self.guess_type(path)).startswith(QLARqstHandler.compressible_types)
+            st = os.stat(path)
+            codings = parse_accept_encoding(self.headers.get('Accept-Encoding', ''),
+                                            QLARqstHandler.precompressed_suffixes.keys())
+            for coding in codings:
+                # Precompressed files older than the file are stale
+                precompressed = path + QLARqstHandler.precompressed_suffixes[coding]
+                try:
+                    pst = os.stat(precompressed)
+                except OSError:
+                    continue
+                if pst.st_mtime >= st.st_mtime:
+                    self.send_static(precompressed, mimetype,
+                                     [('Content-Encoding', coding), ('Vary', 'Accept-Encoding')])
+                    return
+            if (compressible and QLARqstHandler.m_opts.compress and
+                    st.st_size >= QLARqstHandler.m_opts.compress_min_size):
+                codings = parse_accept_encoding(self.headers.get('Accept-Encoding', ''),
+                                                QLARqstHandler.content_encodings)
+                if codings:
+                    self.send_compressed(path, st, mimetype, codings[0])
+                    return
+            self.send_static(path, mimetype, [('Vary', 'Accept-Encoding')] if compressible else [])
+
+        def send_static(self, path, mimetype, headers=()):
             '''
-            Display some useful server information.
+            Send a file as is, from the cache if it is there
+            :param path: Full path of the file
+            :param mimetype: Content type of the file
+            :param headers: additional (name, value) headers
+            :return: -
+            '''
+            cache = QLARqstHandler.m_cache
+            if cache is not None:
+                st = os.stat(path)
+                data = cache.get(path, st)
+                if data is not None:
+                    self.send_contents(data, st.st_size, st.st_mtime, make_etag(st), mimetype, headers)
+                    return
+            with open(path, 'rb') as ifp:
+                st = os.fstat(ifp.fileno())
+                data = cache.load(path, ifp, st) if cache is not None else None
+                self.send_contents(data if data is not None else ifp,
+                                   st.st_size, st.st_mtime, make_etag(st), mimetype, headers)
 
-            http://127.0.0.1:8080/info
+        def send_compressed(self, path, st, mimetype, coding):
             '''
-            self.send_content()
+            Send a file compressed on the fly.  Compressed contents that fit
+            in the cache are kept there, larger ones are compressed while
+            they are sent, in chunks
+            :param path: Full path of the file
+            :param st: os.stat result of the file
+            :param mimetype: Content type of the file
+            :param coding: Content coding, "gzip" or "br"
+            :return: -
+            '''
+            headers = [('Content-Encoding', coding), ('Vary', 'Accept-Encoding')]
+            # Every representation needs its own entity tag
+            etag = make_etag(st)[:-1] + '-' + coding + '"'
+            # Revalidations are answered before anything is compressed
+            if self.not_modified(etag, st.st_mtime):
+                self.send_not_modified(etag, self.date_time_string(st.st_mtime), headers)
+                return
+            cache = QLARqstHandler.m_cache
+            if cache is not None:
+                data = cache.get((path, coding), st)
+                if data is not None:
+                    self.send_contents(data, len(data), st.st_mtime, etag, mimetype, headers)
+                    return
 
-            self.wfile.write('<html><head><title>Server Info</title></head>')
-            self.wfile.write('<body><table><tbody>')
-            self.wfile.write('<tr><td>client_address</td><td>%r</td></tr>' % (repr(self.client_address)))
-            self.wfile.write('<tr><td>command</td><td>%r</td></tr>' % (repr(self.command)))
-            self.wfile.write('<tr><td>headers</td><td>%r</td></tr>' % (repr(self.headers)))
-            self.wfile.write('<tr><td>path</td><td>%r</td></tr>' % (repr(self.path)))
-            self.wfile.write('<tr><td>server_version</td><td>%r</td></tr>' % (repr(self.server_version)))
-            self.wfile.write('<tr><td>sys_version</td><td>%r</td></tr>' % (repr(self.sys_version)))
-            self.wfile.write('</tbody></table></body></html>')
+            with open(path, 'rb') as ifp:
+                st = os.fstat(ifp.fileno())
+                compress, finish = make_compressor(coding)
+                if cache is not None and st.st_size <= cache.max_file_bytes:
+                    data = compress(ifp.read()) + finish()
+                    cache.put((path, coding), st, data)
+                    self.send_contents(data, len(data), st.st_mtime, etag, mimetype, headers)
+                    return
 
-        def do_get_task(self):
+                last_modified = self.date_time_string(st.st_mtime)
+                self.send_chunked_content(mimetype=mimetype,
+                                          headers=headers + [('ETag', etag),
+                                                             ('Last-Modified', last_modified)])
+                while True:
+                    data = ifp.read(COPY_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.write_chunk(compress(data))
+                self.write_chunk(finish())
+                self.end_chunks()
+
+        def send_contents(self, body, size, mtime, etag, mimetype, headers=()):
+            '''
+            Send the whole contents of a file, or the byte ranges requested
+            :param body: File object open for reading, or cached contents
+            :param size: Size of the contents
+            :param mtime: Modification time of the file
+            :param etag: Entity tag of the contents
+            :param mimetype: Content type of the file
+            :param headers: additional (name, value) headers
+            :return: -
             '''
-            Provide input data to the client to run a new task
+            last_modified = self.date_time_string(mtime)
+
+            if self.not_modified(etag, mtime):
+                self.send_not_modified(etag, last_modified, headers)
+                return
 
-            http://127.0.0.1:8080/get_task
+            # Partial content is only sent if the client copy is still
+            # the current one (If-Range), otherwise the whole file goes
+            ranges = None
+            if 'Range' in self.headers:
+                if_range = self.headers.get('If-Range')
+                if (if_range is None or if_range.strip() == last_modified or
+                        etag_matches(if_range, etag, weak=False)):
+                    ranges = parse_byte_ranges(self.headers['Range'], size)
+
+            if ranges is None:
+                self.send_content(mimetype=mimetype, more=True)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                self.stream_body(body, 0, size)
+            elif len(ranges) < 1:
+                self.send_content(code=416, more=True)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_ranges(body, ranges, size, mimetype, last_modified, etag, headers)
+
+        def send_not_modified(self, etag, last_modified, headers=()):
+            '''
+            Send a 304 Not Modified response
+            :param etag: Entity tag of the contents
+            :param last_modified: Last-Modified date of the file
+            :param headers: additional (name, value) headers
             :return: -
             '''
-            pool_of_files = []
-            # Check pool of files
-            if len(QLARqstHandler.pool_of_files) < 1:
-                self.get_new_input_files(QLARqstHandler.pool_of_files)
+            self.send_content(code=304, mimetype='')
+            for name, value in headers:
+                if name != 'Content-Encoding':
+                    self.send_header(name, value)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
 
-            in_file = QLARqstHandler.pool_of_files.pop(0)
-            out_file = re.sub('.fits', '.json', re.sub('LE1_VIS', 'QLA_LE1-VIS', in_file))
-            log_file = re.sub('.json', '.log', re.sub('LE1-VIS', 'LE1-VIS-LOG', out_file))
-            new_task_id = strftime("QDTsrv_%Y%m%d-%H%M%S", gmtime())
+        def not_modified(self, etag, mtime):
+            '''
+            Check whether the copy of the client is still the current one,
+            from the If-None-Match or If-Modified-Since headers
+            :param etag: Entity tag of the file
+            :param mtime: Modification time of the file
+            :return: Whether a 304 Not Modified answer must be sent
+            '''
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match is not None:
+                # If-Modified-Since is ignored when there is If-None-Match
+                return etag_matches(if_none_match, etag)
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if if_modified_since is not None:
+                since = parse_http_date(if_modified_since)
+                return since is not None and int(mtime) <= since
+            return False
 
-            QLARqstHandler.current_file = in_file
-            QLARqstHandler.task_inputs[new_task_id] = in_file
+        def send_ranges(self, body, ranges, size, mimetype, last_modified, etag, headers=()):
+            '''
+            Send a 206 Partial Content response with the requested byte
+            ranges of a file: a single range goes as the body, several
+            ranges go as a multipart/byteranges body
+            :param body: File object open for reading, or cached contents
+            :param ranges: List of (first, last) byte positions
+            :param size: Full size of the file
+            :param mimetype: Content type of the file
+            :param last_modified: Last-Modified date of the file
+            :param etag: Entity tag of the file
+            :param headers: additional (name, value) headers
+            :return: -
+            '''
+            if len(ranges) == 1:
+                first, last = ranges[0]
+                self.send_content(code=206, mimetype=mimetype, more=True)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(first, last, size))
+                self.send_header('Content-Length', str(last - first + 1))
+                self.end_headers()
+                self.stream_body(body, first, last - first + 1)
+                return
 
-            # Build JSON dictionary with task information
-            task_params = {'task_id': new_task_id,
-                           'in_file': in_file,
-                           'out_file': out_file,
-                           'log_file': log_file,
-                           'retrieve_path': QLARqstHandler.input_files_dir}
-            task_params_jsonstr = json.dumps(task_params)
-            logging.debug(task_params_jsonstr)
-            logging.debug('There are {} files left in the pool'.format(len(QLARqstHandler.pool_of_files)))
+            boundary = 'QDTsrv_{}'.format(os.urandom(12).encode('hex'))
+            part_headers = []
+            length = 0
+            for first, last in ranges:
+                part_header = ('\r\n--{}\r\n'
+                               'Content-Type: {}\r\n'
+                               'Content-Range: bytes {}-{}/{}\r\n\r\n').format(boundary, mimetype,
+                                                                              first, last, size)
+                part_headers.append(part_header)
+                length += len(part_header) + last - first + 1
+            trailer = '\r\n--{}--\r\n'.format(boundary)
+            length += len(trailer)
 
-            # Send it
-            self.send_content(mimetype='application/json')
-            self.wfile.write(task_params_jsonstr)
+            self.send_content(code=206, mimetype='multipart/byteranges; boundary=' + boundary,
+                              more=True)
+            for name, value in headers:
+                self.send_header(name, value)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Content-Length', str(length))
+            self.end_headers()
+            for part_header, (first, last) in zip(part_headers, ranges):
+                self.wfile.write(part_header)
+                self.stream_body(body, first, last - first + 1)
+            self.wfile.write(trailer)
 
-        def do_end_task(self, task_id):
+        def stream_body(self, body, offset, count):
+            '''
+            Send count bytes of a file, starting at offset
+            :param body: File object open for reading, or cached contents
+            :param offset: Position of the first byte to send
+            :param count: Number of bytes to send
+            :return: -
             '''
-            Provide input data to the client to run a new task
+            rate = self.injected_rate()
+            if rate is not None:
+                self.send_paced(body, offset, count, rate)
+            elif isinstance(body, str):
+                self.send_cached(body, offset, count)
+            else:
+                self.stream_file(body, offset, count)
 
-            http://127.0.0.1:8080/end_task
+        def send_paced(self, body, offset, count, rate):
             '''
-            task_file = QLARqstHandler.task_inputs[task_id]
-            from_file = './{}/{}'.format(QLARqstHandler.input_files_dir, task_file)
-            to_file = './{}/{}'.format(QLARqstHandler.processed_files_dir, task_file)
-            logging.debug('Trying to move {} to {}'.format(from_file, to_file))
-            os.rename(from_file, to_file)
-            self.send_content()
+            Send count bytes of a file, starting at offset, no faster than
+            an artificial bandwidth limit
+            :param body: File object open for reading, or cached contents
+            :param offset: Position of the first byte to send
+            :param count: Number of bytes to send
+            :param rate: Bytes per second
+            :return: -
+            '''
+            self.wfile.flush()
+            block_size = max(int(rate / 10), 1024)
+            if not isinstance(body, str):
+                body.seek(offset)
+            start = time()
+            sent = 0
+            while sent < count:
+                size = min(block_size, count - sent)
+                if isinstance(body, str):
+                    data = memoryview(body)[offset + sent:offset + sent + size]
+                else:
+                    data = body.read(size)
+                if not data:
+                    break
+                self.connection.sendall(data)
+                sent += len(data)
+                ahead = start + sent / rate - time()
+                if ahead > 0:
+                    sleep(ahead)
 
-        def send_file(self, path):
+        def send_cached(self, data, offset, count):
             '''
-            Sends an existing, requested file
-            :param path: Full path of the requested file
+            Send count bytes of cached contents, starting at offset, through
+            a memoryview so that they are not copied
+            :param data: Cached contents
+            :param offset: Position of the first byte to send
+            :param count: Number of bytes to send
             :return: -
             '''
-            _, ext = os.path.splitext(path)
-            ext = ext.lower()
+            # Headers may still be buffered in wfile
+            self.wfile.flush()
+            self.connection.sendall(memoryview(data)[offset:offset + count])
 
-            # This is a test, files are tiny, so let's simulate that it takes a bit of time
-            if QLARqstHandler.generate_dummy_files:
-                sleep(10)
+        def stream_file(self, ifp, offset, count):
+            '''
+            Send count bytes of an open file, starting at offset, without
+            loading the file in memory.  The kernel sendfile() call is used
+            when available, and fixed-size chunks are copied otherwise
+            :param ifp: File object open for reading
+            :param offset: Position of the first byte to send
+            :param count: Number of bytes to send
+            :return: -
+            '''
+            if sendfile is not None and QLARqstHandler.m_opts.sendfile:
+                # Headers may still be buffered in wfile
+                self.wfile.flush()
+                out_fd = self.connection.fileno()
+                in_fd = ifp.fileno()
+                try:
+                    while count > 0:
+                        try:
+                            sent = sendfile(out_fd, in_fd, offset, count)
+                        except (OSError, IOError) as e:
+                            if e.errno != errno.EAGAIN:
+                                raise
+                            # The idle timeout makes the socket non-blocking:
+                            # wait until it can take more, as sendall does
+                            if not select.select([], [out_fd], [], self.timeout)[1]:
+                                raise socket.timeout('timed out')
+                            continue
+                        if sent == 0:
+                            break
+                        offset += sent
+                        count -= sent
+                    return
+                except (OSError, IOError) as e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+                    # The file system or socket does not support it,
+                    # go on with the remaining bytes the slow way
+                    logging.debug('sendfile not available for {}: {}'.format(ifp.name, e))
 
-            # If it is a known extension, set the correct
-            # content type in the response.
-            if ext in QLARqstHandler.content_type:
-                self.send_content(mimetype=QLARqstHandler.content_type[ext])
-                with open(path) as ifp:
-                    self.wfile.write(ifp.read())
-            else:
-                # Unknown file type or a directory.
-                # Treat it as plain text.
-                self.send_content()
-                with open(path) as ifp:
-                    self.wfile.write(ifp.read())
+            ifp.seek(offset)
+            while count > 0:
+                data = ifp.read(min(COPY_CHUNK_SIZE, count))
+                if not data:
+                    break
+                self.wfile.write(data)
+                count -= len(data)
+
+        def stream_array(self, data, block_rows):
+            '''
+            Send the bytes of an array, block_rows rows at a time
+            :param data: Array, possibly memory mapped
+            :param block_rows: Number of rows read and sent at once
+            :return: -
+            '''
+            for row in range(0, data.shape[0], block_rows):
+                self.wfile.write(data[row:row + block_rows].tobytes())
 
         def do_GET(self):
             '''
@@ -351,10 +4201,46 @@ def make_request_handler_class(opts):
             # displays some internal information.
             if self.path == '/info' or self.path == '/info/':
                 self.do_info()
+            elif rpath == '/status' or self.path == '/status/':
+                self.do_status()
             elif rpath == '/get_task' or self.path == '/get_task/':
-                self.do_get_task()
+                try:
+                    wait = float(args['wait'][0]) if 'wait' in args else None
+                except ValueError:
+                    self.send_bad_request('Invalid wait time')
+                    return
+                self.do_get_task(wait=wait)
+            elif rpath == '/get_tasks' or self.path == '/get_tasks/':
+                try:
+                    wait = float(args['wait'][0]) if 'wait' in args else None
+                    n = int(args['n'][0]) if 'n' in args else 1
+                except ValueError:
+                    self.send_bad_request('Invalid number of tasks or wait time')
+                    return
+                self.do_get_tasks(n, wait=wait)
+            elif rpath in ('/end_task', '/heartbeat', '/task_status') and 'task_id' not in args:
+                self.send_bad_request('Missing task_id')
             elif rpath == '/end_task' or self.path == '/end_task/':
-                self.do_end_task(task_id=args['task_id'][0])
+                self.do_end_task(task_ids=args['task_id'])
+            elif rpath == '/task_status' or self.path == '/task_status/':
+                self.do_task_status(task_ids=args['task_id'])
+            elif rpath == '/heartbeat' or self.path == '/heartbeat/':
+                self.do_heartbeat(task_id=args['task_id'][0])
+            elif rpath == '/meta' or self.path == '/meta/':
+                if 'file' not in args:
+                    self.send_bad_request('Missing file')
+                else:
+                    self.do_meta(file_name=args['file'][0])
+            elif rpath == '/search' or self.path == '/search/':
+                self.do_search(criteria=args)
+            elif rpath in ('/cutout', '/stats', '/preview') and 'file' not in args:
+                self.send_bad_request('Missing file')
+            elif rpath == '/cutout' or self.path == '/cutout/':
+                self.do_cutout(args)
+            elif rpath == '/stats' or self.path == '/stats/':
+                self.do_stats(args)
+            elif (rpath == '/preview' or self.path == '/preview/') and QLARqstHandler.m_previews is not None:
+                self.do_preview(args)
             else:
                 # Get the file path.
                 path = QLARqstHandler.m_opts.rootdir + rpath
@@ -385,22 +4271,25 @@ def make_request_handler_class(opts):
                     self.send_file(path)
                 else:
                     # Invalid file path, respond with a server access error
-                    self.send_content(code=500)  # generic server error for now
-                    self.wfile.write('<html>')
-                    self.wfile.write('  <head>')
-                    self.wfile.write('    <title>Server Access Error</title>')
-                    self.wfile.write('  </head>')
-                    self.wfile.write('  <body>')
-                    self.wfile.write('    <p>Server access error.</p>')
-                    self.wfile.write('    <p>%r</p>' % (repr(self.path)))
-                    self.wfile.write('    <p><a href="%s">Back</a></p>' % (rpath))
-                    self.wfile.write('  </body>')
-                    self.wfile.write('</html>')
+                    # generic server error for now
+                    self.send_body('<html>'
+                                   '  <head>'
+                                   '    <title>Server Access Error</title>'
+                                   '  </head>'
+                                   '  <body>'
+                                   '    <p>Server access error.</p>'
+                                   '    <p>%r</p>'
+                                   '    <p><a href="%s">Back</a></p>'
+                                   '  </body>'
+                                   '</html>' % (repr(self.path), rpath), code=500)
 
         def do_POST(self):
             """Serve a POST request."""
             r, info = self.deal_post_data()
             print r, info, "by: ", self.client_address
+            if not r:
+                # The rest of the body may not have been read
+                self.close_connection = 1
             f = StringIO()
             f.write('<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">')
             f.write("<html>\n<title>Upload Result Page</title>\n")
@@ -422,53 +4311,44 @@ def make_request_handler_class(opts):
                 f.close()
 
         def deal_post_data(self):
-            boundary = self.headers.plisttext.split("=")[1]
-            remainbytes = int(self.headers['content-length'])
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            if not boundary in line:
-                return (False, "Content NOT begin with boundary")
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            fn = re.findall(r'Content-Disposition.*name="file"; filename="(.*)"', line)
-            if not fn:
-                return (False, "Can't find out file name...")
-            logging.debug("Trying to upload %s", fn)
+            ctype, params = cgi.parse_header(self.headers.get('content-type', ''))
+            if ctype != 'multipart/form-data' or 'boundary' not in params:
+                return (False, "Content is not multipart/form-data")
+            try:
+                length = int(self.headers['content-length'])
+            except (KeyError, ValueError):
+                return (False, "Content length is missing")
             path = self.translate_path(self.path)
-            fn = os.path.join(path, fn[0])
-            logging.debug("... which translate to %s", fn)
-#            line = self.rfile.readline()
-#            remainbytes -= len(line)
-            line = self.rfile.readline()
-            remainbytes -= len(line)
+            uploaded = []
+
+            def open_part(headers):
+                _, disposition = cgi.parse_header(headers.get('content-disposition', ''))
+                if not disposition.get('filename'):
+                    return None
+                logging.debug("Trying to upload %s", disposition['filename'])
+                fn = os.path.join(path, os.path.basename(disposition['filename']))
+                logging.debug("... which translate to %s", fn)
+                try:
+                    out = open(fn, 'wb')
+                except IOError:
+                    import grp, pwd
+                    userhome = os.path.expanduser('~')
+                    user = os.path.split(userhome)[-1]
+                    groups = [g.gr_name for g in grp.getgrall() if user in g.gr_mem]
+                    gid = pwd.getpwnam(user).pw_gid
+                    groups.append(grp.getgrgid(gid).gr_name)
+                    logging.debug("%s : %s",user, ','.join(groups))
+                    raise ValueError("Can't create file to write, do you have permission to write?")
+                uploaded.append(fn)
+                return out
+
             try:
-                out = open(fn, 'wb')
-            except IOError:
-                import grp, pwd
-                userhome = os.path.expanduser('~')
-                user = os.path.split(userhome)[-1]
-                groups = [g.gr_name for g in grp.getgrall() if user in g.gr_mem]
-                gid = pwd.getpwnam(user).pw_gid
-                groups.append(grp.getgrgid(gid).gr_name)
-                logging.debug("%s : %s",user, ','.join(groups))
-                return (False, "Can't create file to write, do you have permission to write?")
-
-            preline = self.rfile.readline()
-            remainbytes -= len(preline)
-            while remainbytes > 0:
-                line = self.rfile.readline()
-                remainbytes -= len(line)
-                if boundary in line:
-                    preline = preline[0:-1]
-                    if preline.endswith('\r'):
-                        preline = preline[0:-1]
-                    out.write(preline)
-                    out.close()
-                    return (True, "File '%s' upload success!" % fn)
-                else:
-                    out.write(preline)
-                    preline = line
-            return (False, "Unexpect Ends of data.")
+                MultipartReader(self.rfile, params['boundary'], length).read_parts(open_part)
+            except ValueError as e:
+                return (False, str(e))
+            if not uploaded:
+                return (False, "Can't find out file name...")
+            return (True, ' '.join("File '%s' upload success!" % fn for fn in uploaded))
 
         def translate_path(self, path):
             """Translate a /-separated PATH to the local filename syntax.
@@ -557,12 +4437,73 @@ def getopts():
                                      description=description,
                                      epilog=epilog)
 
+    parser.add_argument('--cache-size',
+                        action='store',
+                        type=int,
+                        default=64,
+                        help='MiB of memory used to cache the files served (0 disables it), '
+                             'default=%(default)s')
+
+    parser.add_argument('--cache-max-file',
+                        action='store',
+                        type=int,
+                        default=8,
+                        help='MiB of the largest file kept in the cache, default=%(default)s')
+
+    parser.add_argument('--no-compress',
+                        action='store_false',
+                        dest='compress',
+                        help='do not compress files on the fly (precompressed .gz/.br files '
+                             'are still served)')
+
+    parser.add_argument('--compress-min-size',
+                        action='store',
+                        type=int,
+                        default=1024,
+                        help='bytes of the smallest file compressed on the fly, default=%(default)s')
+
+    parser.add_argument('--delay',
+                        action='append',
+                        default=[],
+                        metavar='PREFIX=DIST',
+                        help='inject a delay in the requests whose path starts with PREFIX, '
+                             'e.g. /input/=uniform:0.5:2 (see LatencyInjector), can be repeated, '
+                             'not with --engine pool')
+
+    parser.add_argument('--bandwidth',
+                        action='append',
+                        default=[],
+                        metavar='PREFIX=RATE',
+                        help='limit the bytes per second of the files whose path starts with '
+                             'PREFIX, e.g. /input/=2M, can be repeated, not with --engine pool')
+
+    parser.add_argument('--latency-seed',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='seed of the injected delays, default=%(default)s')
+
+    parser.add_argument('-e', '--engine',
+                        action='store',
+                        type=str,
+                        default='threads',
+                        choices=['threads', 'pool', 'async'],
+                        help='serving engine: a thread per connection, a fixed pool of '
+                        'threads, or a single event-driven thread, default=%(default)s')
+
     parser.add_argument('-H', '--host',
                         action='store',
                         type=str,
                         default='localhost',
                         help='hostname, default=%(default)s')
 
+    parser.add_argument('--idle-timeout',
+                        action='store',
+                        type=int,
+                        default=60,
+                        help='seconds before idle keep-alive connections are closed, '
+                        'default=%(default)s')
+
     parser.add_argument('-l', '--level',
                         action='store',
                         type=str,
@@ -574,6 +4515,121 @@ def getopts():
                         action='store_true',
                         help='disable directory listings')
 
+    parser.add_argument('--no-sendfile',
+                        action='store_false',
+                        dest='sendfile',
+                        help='copy files in chunks instead of using zero-copy sendfile()')
+
+    parser.add_argument('--stats-workers',
+                        action='store',
+                        type=int,
+                        default=2,
+                        help='processes computing the /stats of the files (0 computes them in '
+                             'the server threads), default=%(default)s')
+
+    parser.add_argument('--preview-cache',
+                        action='store',
+                        type=int,
+                        default=256,
+                        help='MiB of disk used to cache the /preview images (0 disables '
+                             'them), default=%(default)s')
+
+    parser.add_argument('--preview-dir',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='folder of the preview cache, default=ROOTDIR/previews')
+
+    parser.add_argument('--preview-size',
+                        action='store',
+                        type=int,
+                        default=512,
+                        help='maximum width and height of the previews, default=%(default)s')
+
+    parser.add_argument('--preview-workers',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='processes rendering the previews asked for (0 renders them in '
+                             'the server threads), default=%(default)s')
+
+    parser.add_argument('--no-prerender',
+                        action='store_false',
+                        dest='prerender',
+                        help='only render the previews when they are asked for, instead of '
+                             'rendering those of all the input and processed files in the background')
+
+    parser.add_argument('-w', '--workers',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='number of server processes sharing the port, default=%(default)s')
+
+    parser.add_argument('--pool-size',
+                        action='store',
+                        type=int,
+                        default=16,
+                        help='number of worker threads of the pool engine, default=%(default)s')
+
+    parser.add_argument('--queue-depth',
+                        action='store',
+                        type=int,
+                        default=64,
+                        help='connections waiting for a worker before the pool engine '
+                        'answers 503, default=%(default)s')
+
+    parser.add_argument('--task-wait',
+                        action='store',
+                        type=float,
+                        default=30,
+                        help='maximum seconds a get_task request waits for new input files '
+                        'before answering 204, default=%(default)s')
+
+    parser.add_argument('--lease-ttl',
+                        action='store',
+                        type=float,
+                        default=600,
+                        help='seconds a dispatched task may run without a heartbeat before '
+                        'its input file is requeued (0 to disable), default=%(default)s')
+
+    parser.add_argument('--task-retention',
+                        action='store',
+                        type=float,
+                        default=600,
+                        help='seconds the status of a finished task is kept for /task_status, '
+                        'default=%(default)s')
+
+    parser.add_argument('--max-batch',
+                        action='store',
+                        type=int,
+                        default=100,
+                        help='maximum number of tasks dispatched by a get_tasks request, '
+                        'default=%(default)s')
+
+    parser.add_argument('--prefetch-depth',
+                        action='store',
+                        type=int,
+                        default=4,
+                        help='next input files of the queue read ahead into the page cache '
+                             '(0 disables it), default=%(default)s')
+
+    parser.add_argument('-j', '--journal',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='file where the state of the tasks is kept across restarts '
+                             '(outside the root directory), default=%(default)s')
+
+    parser.add_argument('--poll-input',
+                        action='store_true',
+                        help='scan the input folder periodically instead of using inotify')
+
+    parser.add_argument('--poll-interval',
+                        action='store',
+                        type=float,
+                        default=2,
+                        help='seconds between scans of the input folder, default=%(default)s')
+
     parser.add_argument('-p', '--port',
                         action='store',
                         type=int,
@@ -596,21 +4652,77 @@ def getopts():
 
     opts = parser.parse_args()
     opts.rootdir = os.path.abspath(opts.rootdir)
+    if opts.journal:
+        opts.journal = os.path.abspath(opts.journal)
+    opts.preview_dir = os.path.abspath(opts.preview_dir or os.path.join(opts.rootdir, 'previews'))
     if not os.path.isdir(opts.rootdir):
         err('Root directory does not exist: ' + opts.rootdir)
     if opts.port < 1 or opts.port > 65535:
         err('Port is out of range [1..65535]: %d' % (opts.port))
+    if opts.cache_size < 0 or opts.cache_max_file < 0:
+        err('Cache sizes cannot be negative')
+    try:
+        LatencyInjector(opts.delay, opts.bandwidth)
+    except ValueError as e:
+        err(str(e))
+    if (opts.delay or opts.bandwidth) and opts.engine == 'pool':
+        err('--delay and --bandwidth would hold the threads of the pool engine, '
+            'use --engine async or threads')
+    if opts.pool_size < 1 or opts.queue_depth < 1:
+        err('Pool size and queue depth must be positive')
+    if opts.prefetch_depth < 0:
+        err('The prefetch depth cannot be negative')
+    if opts.task_retention <= 0:
+        err('The task retention must be positive')
+    if opts.stats_workers < 0 or opts.preview_workers < 0:
+        err('The number of stats and preview workers cannot be negative')
+    if opts.preview_cache < 0:
+        err('The preview cache size cannot be negative')
+    if not 16 <= opts.preview_size <= 4096:
+        err('The preview size is out of range [16..4096]: %d' % (opts.preview_size))
+    if opts.workers < 1:
+        err('The number of workers must be positive')
+    if opts.workers > 1 and SO_REUSEPORT is None:
+        err('Several workers need SO_REUSEPORT, not available on this platform')
     return opts
 
 
-def httpd(opts):
+def make_server(opts, RequestHandlerClass, reuse_port=False):
     '''
-    HTTP server
+    Create the server of the selected engine, bound to the requested
+    address.  With reuse_port, other processes can bind it as well.
     '''
-    RequestHandlerClass = make_request_handler_class(opts)
     # server = BaseHTTPServer.HTTPServer((opts.host, opts.port), RequestHandlerClass)
-    server = ThreadedHTTPServer((opts.host, opts.port), RequestHandlerClass)
-    logging.info('Server starting %s:%s (level=%s)' % (opts.host, opts.port, opts.level))
+    if opts.engine == 'async':
+        return AsyncHTTPServer((opts.host, opts.port), RequestHandlerClass,
+                               idle_timeout=opts.idle_timeout, reuse_port=reuse_port)
+    elif opts.engine == 'pool':
+        server = PoolHTTPServer((opts.host, opts.port), RequestHandlerClass,
+                                bind_and_activate=False,
+                                pool_size=opts.pool_size, queue_depth=opts.queue_depth)
+    else:
+        server = ThreadedHTTPServer((opts.host, opts.port), RequestHandlerClass,
+                                    bind_and_activate=False)
+    try:
+        if reuse_port:
+            server.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        server.server_bind()
+        server.server_activate()
+    except:
+        server.server_close()
+        raise
+    return server
+
+
+def serve(opts, tasks, reuse_port=False):
+    '''
+    Run a server until interrupted
+    '''
+    RequestHandlerClass = make_request_handler_class(opts, tasks)
+    server = make_server(opts, RequestHandlerClass, reuse_port)
+    logging.info('Server starting %s:%s (level=%s, engine=%s, pid=%d)' % (opts.host, opts.port,
+                                                                          opts.level, opts.engine,
+                                                                          os.getpid()))
     try:
         server.serve_forever()
     except KeyboardInterrupt:
@@ -619,6 +4731,98 @@ def httpd(opts):
     logging.info('Server stopping %s:%s' % (opts.host, opts.port))
 
 
+def serve_worker(opts, tasks):
+    '''
+    Run a worker process of the supervisor
+    '''
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    serve(opts, tasks, reuse_port=True)
+
+
+def stop_supervisor(signum, frame):
+    '''
+    Handle SIGTERM in the supervisor like Ctrl-C, so that the workers are
+    stopped as well
+    '''
+    raise KeyboardInterrupt
+
+
+def supervise(opts, tasks):
+    '''
+    Start the worker processes, all of them listening on the same port,
+    and restart any of them that dies until interrupted
+    '''
+    workers = {}
+
+    def start_worker(i):
+        worker = multiprocessing.Process(target=serve_worker, args=(opts, tasks),
+                                         name='worker-{}'.format(i))
+        worker.start()
+        workers[i] = worker
+
+    signal.signal(signal.SIGTERM, stop_supervisor)
+    for i in range(opts.workers):
+        start_worker(i)
+    try:
+        while True:
+            sleep(1)
+            for i, worker in workers.items():
+                if not worker.is_alive():
+                    logging.warning('Worker %d (pid %d) exited with code %s, restarting' %
+                                    (i, worker.pid, worker.exitcode))
+                    start_worker(i)
+    except KeyboardInterrupt:
+        pass
+    for worker in workers.values():
+        worker.terminate()
+    for worker in workers.values():
+        worker.join()
+
+
+def ignore_sigint():
+    '''
+    Let the supervisor stop the manager process, instead of Ctrl-C
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def init_helper_process():
+    '''
+    Initialize a process of a helper pool: Ctrl-C is handled by the
+    server, and the process ends with the server even if it is killed
+    (Linux only)
+    '''
+    ignore_sigint()
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        libc.prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except (OSError, AttributeError):
+        pass
+
+
+def httpd(opts):
+    '''
+    HTTP server
+    '''
+    if opts.workers > 1:
+        manager = TaskManager()
+        manager.start(ignore_sigint)
+        tasks = manager.TaskStore(opts.rootdir, opts.lease_ttl, opts.journal, opts.task_retention)
+    else:
+        tasks = TaskStore(opts.rootdir, opts.lease_ttl, opts.journal, opts.task_retention)
+    tasks.start_watcher(opts.poll_interval, not opts.poll_input)
+    tasks.start_completions()
+    tasks.start_reaper()
+    tasks.start_prefetcher(opts.prefetch_depth)
+    if opts.preview_cache > 0 and opts.prerender:
+        tasks.start_previews(opts.preview_dir, opts.preview_cache * 1024 * 1024, opts.preview_size)
+    if opts.workers > 1:
+        supervise(opts, tasks)
+        manager.shutdown()
+    else:
+        serve(opts, tasks)
+
+
 def get_logging_level(opts):
     '''
     Get the logging levels specified on the command line.